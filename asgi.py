@@ -0,0 +1,10 @@
+from scan_explorer_service import app
+from scan_explorer_service.asgi import AsyncImageProxy
+
+application = AsyncImageProxy(app)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(application, host='0.0.0.0', port=8181, lifespan='on')
@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from flask import jsonify
+from scan_explorer_service import app
+from scan_explorer_service.extensions import manifest_cache
+from scan_explorer_service.models import Article, Collection
+from scan_explorer_service.utils.cache_utils import atomic_write
+from scan_explorer_service.views.manifest import create_manifest_json, get_item, manifest_version, set_manifest_base_uris
+import argparse
+import os
+import time
+from adsmutils import setup_logging, load_config
+
+# ============================= INITIALIZATION ==================================== #
+
+proj_home = os.path.realpath(os.path.dirname(__file__))
+config = load_config(proj_home=proj_home)
+logger = setup_logging('prewarm_manifests.py', proj_home=proj_home,
+                        level=config.get('LOGGING_LEVEL', 'INFO'),
+                        attach_stdout=config.get('LOG_STDOUT', False))
+
+VERSION_FILE = '.manifest-version'
+
+# Options of the current run, set in every worker process by init_worker
+output_dir: Optional[str] = None
+incremental = False
+
+# =============================== FUNCTIONS ======================================= #
+
+def init_worker(worker_output_dir: Optional[str], worker_incremental: bool):
+    global output_dir, incremental
+    output_dir = worker_output_dir
+    incremental = worker_incremental
+    # Connections inherited from the parent process must not be shared
+    app.db.engine.dispose()
+
+
+def read_version(directory: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, VERSION_FILE), 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def prewarm_manifest(id: str) -> Tuple[str, str, Optional[str]]:
+    """ Builds and stores the manifest of an article or collection.
+
+    Returns the id with 'built', 'skipped' or 'failed' and the error of a failure.
+    """
+    try:
+        with app.test_request_context(), app.session_scope() as session:
+            set_manifest_base_uris()
+            item = get_item(session, id)
+            version = manifest_version(item)
+            directory = os.path.join(output_dir, id) if output_dir else None
+
+            if incremental:
+                if directory and read_version(directory) == version:
+                    return id, 'skipped', None
+                if not directory and manifest_cache.contains(id, version):
+                    return id, 'skipped', None
+
+            body = jsonify(create_manifest_json(session, item)).get_data()
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                atomic_write(os.path.join(directory, 'manifest.json'), body)
+                atomic_write(os.path.join(directory, VERSION_FILE), version.encode('utf-8'))
+            else:
+                manifest_cache.set(id, version, body)
+        return id, 'built', None
+    except Exception as e:
+        return id, 'failed', repr(e)
+
+
+def item_ids(types):
+    with app.session_scope() as session:
+        ids = []
+        if 'collection' in types:
+            ids.extend(id for id, in session.query(Collection.id).order_by(Collection.id))
+        if 'article' in types:
+            ids.extend(id for id, in session.query(Article.id).order_by(Article.id))
+        return ids
+
+
+def prewarm(ids, workers: int, output_dir: Optional[str], incremental: bool) -> dict:
+    counts = {'built': 0, 'skipped': 0, 'failed': 0}
+    start = time.perf_counter()
+    # Release the connections of the parent before the workers are forked
+    app.db.engine.dispose()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(output_dir, incremental)) as executor:
+        for n, (id, status, error) in enumerate(executor.map(prewarm_manifest, ids, chunksize=16), 1):
+            counts[status] += 1
+            if error:
+                logger.error('Failed to create manifest of %s: %s', id, error)
+            if n % 1000 == 0:
+                logger.info('Processed %d of %d items, %.1f items/s', n, len(ids), n / (time.perf_counter() - start))
+
+    elapsed = time.perf_counter() - start
+    logger.info('Processed %d items in %.1fs, %.1f items/s: %d built, %d skipped, %d failed',
+                len(ids), elapsed, len(ids) / elapsed if elapsed else 0, counts['built'], counts['skipped'], counts['failed'])
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-generates the manifests of all collections and articles')
+
+    parser.add_argument("--workers",
+                    dest="workers",
+                    type=int,
+                    required=False,
+                    default=os.cpu_count(),
+                    help="Number of worker processes building manifests")
+    parser.add_argument("--output-dir",
+                    dest="output_dir",
+                    required=False,
+                    default=None,
+                    help="Writes <id>/manifest.json files to this static directory instead of the manifest cache")
+    parser.add_argument("--incremental",
+                    dest="incremental",
+                    action='store_true',
+                    required=False,
+                    default=False,
+                    help="Only rebuilds manifests of items updated since they were last written")
+    parser.add_argument("--type",
+                    dest="types",
+                    choices=['collection', 'article'],
+                    action='append',
+                    required=False,
+                    help="Only prewarms this type of item, may be repeated. Defaults to both")
+
+    args = parser.parse_args()
+    if not args.output_dir and not app.config.get('MANIFEST_CACHE_DIR'):
+        parser.error('MANIFEST_CACHE_DIR must be configured to prewarm the manifest cache, or use --output-dir')
+
+    ids = item_ids(args.types or ['collection', 'article'])
+    counts = prewarm(ids, args.workers, args.output_dir, args.incremental)
+    if counts['failed']:
+        exit(1)
@@ -14,8 +14,18 @@ def register_extensions(app: ADSFlask):
     limiter.init_app(app)
     discoverer.init_app(app)
     appmap_flask.init_app(app)
+    manifest_cache.init_app(app)
+    image_api_client.init_app(app)
+    search_client.init_app(app)
+    search_cache.init_app(app)
+    image_cache.init_app(app)
+    image_info_cache.init_app(app)
+    pdf_jobs.init_app(app)
+    sprite_cache.init_app(app)
+    thumbnail_cache.init_app(app)
     
     manifest_factory.set_iiif_image_info(2.0, 2)  # Version, ComplianceLevel
+    manifest_factory.set_canvas_cache(app.config.get('CANVAS_CACHE_SIZE', 1000), app.config.get('CANVAS_CACHE_MEMORY_LIMIT', 0))
 
 
 def register_views(app: ADSFlask):
@@ -0,0 +1,274 @@
+import asyncio
+import os
+from contextlib import nullcontext
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+from urllib import parse as urlparse
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+from scan_explorer_service.extensions import image_api_client, image_cache, thumbnail_cache
+from scan_explorer_service.upstream_client import Backend
+from scan_explorer_service.utils.utils import url_for_proxy
+from scan_explorer_service.views.image_proxy import bp_proxy, forwarded_headers, release_once
+
+EXCLUDED_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
+# Same as the after_request handler of the flask application
+CORS_HEADERS = [('Access-Control-Allow-Origin', '*'), ('Access-Control-Allow-Headers', '*'),
+                ('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,PATCH,OPTIONS')]
+
+Headers = List[Tuple[str, str]]
+
+
+class AsyncImageProxy:
+    """ ASGI application serving the image proxy on an asyncio event loop.
+
+    GET requests of the image proxy and of cached thumbnails are streamed
+    from the image server with a non-blocking pooled httpx client, so a slow
+    download holds a socket instead of a thread. They share the image cache,
+    request coalescing and thumbnail cache with the flask views. Everything
+    else, including info.json answered from the database and thumbnails
+    which still have to be resolved, is passed to the flask application,
+    which runs in a thread pool. Rate limits of the flask views don't apply
+    to the requests served here.
+    """
+
+    def __init__(self, app: Flask, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.transport = transport
+        self.client: Optional[httpx.AsyncClient] = None
+        self.iiif_prefix = f'{bp_proxy.url_prefix}/iiif/2/'
+        self.thumbnail_path = f'{bp_proxy.url_prefix}/thumbnail'
+        with app.test_request_context():
+            self.image_proxy_url = url_for_proxy('proxy.image_proxy', path='')
+
+    def create_client(self) -> httpx.AsyncClient:
+        config = self.app.config
+        connect_timeout = config.get('IMAGE_API_CONNECT_TIMEOUT', 3.05)
+        read_timeout = config.get('IMAGE_API_READ_TIMEOUT', 30)
+        limits = httpx.Limits(max_connections=config.get('IMAGE_API_ASYNC_MAX_CONNECTIONS', 200),
+                              max_keepalive_connections=config.get('IMAGE_API_POOL_SIZE', 20))
+        # httpx only retries failed connection attempts
+        transport = self.transport or httpx.AsyncHTTPTransport(limits=limits, retries=config.get('IMAGE_API_RETRIES', 2))
+        return httpx.AsyncClient(transport=transport, follow_redirects=False,
+                                 timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            path = scope['path']
+            root_path = scope.get('root_path', '')
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            args = MultiDict(urlparse.parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+
+            if path.startswith(self.iiif_prefix) and not path.endswith('/info.json'):
+                return await self.image_proxy(scope, send, path[len(self.iiif_prefix):], args)
+            if path.rstrip('/') == self.thumbnail_path:
+                image_path = thumbnail_cache.get(args.get('type'), args.get('id'))
+                if image_path is not None:
+                    return await self.thumbnail(scope, send, image_path)
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.client = self.create_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def thumbnail(self, scope, send, image_path: str):
+        config = self.app.config
+        if not config.get('THUMBNAIL_REDIRECT', False):
+            return await self.image_proxy(scope, send, image_path, MultiDict())
+
+        base_url = config.get('THUMBNAIL_REDIRECT_BASE_URL') or self.image_proxy_url
+        max_age = config.get('THUMBNAIL_REDIRECT_MAX_AGE', 3600)
+        await send_response(send, 302, [('Location', f'{base_url.rstrip("/")}/{image_path}'),
+                                        ('Cache-Control', f'public, max-age={max_age}')])
+
+    async def image_proxy(self, scope, send, path: str, args: MultiDict):
+        """ Same as the image_proxy view """
+        # The forwarded headers of the client are replaced with the values of the service
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']
+                   if name.lower() not in [b'host', b'accept'] and not name.lower().startswith(b'x-forwarded-')}
+        with self.app.app_context():
+            headers.update((name.lower(), value) for name, value in forwarded_headers().items())
+
+        key = image_cache.key(path, args)
+        cache_key = key if image_cache.enabled else None
+        cached = await run_blocking(image_cache.get, cache_key) if cache_key else None
+        if cached and image_cache.is_fresh(cached[0]):
+            return await send_cached(send, headers, *cached, 'HIT')
+
+        release = None
+        if await run_blocking(image_cache.acquire, key):
+            release = release_once(key)
+        else:
+            shared = await image_cache.wait_async(key)
+            coalesced = await run_blocking(image_cache.get, cache_key) if cache_key and not shared else None
+            if shared or (coalesced and image_cache.is_fresh(coalesced[0])):
+                if cached:
+                    cached[1].close()
+                return await send_cached(send, headers, *(shared or coalesced), 'COALESCED')
+            if coalesced:
+                coalesced[1].close()
+
+        try:
+            await self.send_upstream(send, path, args, headers, cache_key, cached, release)
+        finally:
+            if release:
+                await run_blocking(release)
+
+    async def send_upstream(self, send, path: str, args: MultiDict, headers: dict, cache_key: Optional[str],
+                            cached: Optional[Tuple[dict, BinaryIO]], release: Optional[Callable] = None):
+        upstream_headers = dict(headers)
+        if cached:
+            meta, body = cached
+            if meta['etag']:
+                # Let the image server confirm the cached image is still valid
+                upstream_headers['if-none-match'] = meta['etag']
+                upstream_headers.pop('if-modified-since', None)
+
+        if self.client is None:
+            # The server did not send lifespan events
+            self.client = self.create_client()
+        # Balanced over the image servers like the requests of the flask views, with fail over on connection errors
+        backends = image_api_client.backends
+        tried: List[Backend] = []
+        r, error = None, None
+        while r is None and len(tried) < len(backends.backends):
+            backend = backends.acquire(exclude=tried)
+            tried.append(backend)
+            failed = False
+            try:
+                request = self.client.build_request('GET', urlparse.urljoin(f'{backend.url}/', path),
+                                                   params=list(args.items(multi=True)), headers=upstream_headers)
+                r = await self.client.send(request, stream=True)
+            except httpx.PoolTimeout as e:
+                # Only waited on a free connection of the local pool, the image server is not at fault
+                error = e
+                break
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                failed = True
+                error = e
+                if not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+                    break
+            finally:
+                if r is None:
+                    backends.release(backend, not failed)
+
+        if r is None:
+            if cached:
+                return await send_cached(send, headers, meta, body, 'STALE')
+            if isinstance(error, httpx.TimeoutException):
+                return await send_response(send, 504, [('Content-Type', 'application/json')], b'{"Message":"Image server timed out"}')
+            return await send_response(send, 502, [('Content-Type', 'application/json')], b'{"Message":"Image server unavailable"}')
+
+        try:
+            if cached:
+                if r.status_code == 304:
+                    await run_blocking(image_cache.refresh, cache_key, meta, r.headers)
+                    return await send_cached(send, headers, meta, body, 'REVALIDATED')
+                body.close()
+
+            response_headers = [(name, value) for name, value in r.headers.multi_items() if name.lower() not in EXCLUDED_HEADERS]
+            ttl = image_cache.ttl(r.headers)
+            etag = r.headers.get('ETag')
+            shared_body = None
+            if release:
+                if not image_cache.shareable(r.status_code, ttl):
+                    # The waiting requests have to fetch their own response
+                    await run_blocking(release)
+                elif not cache_key:
+                    shared_body = []
+            store = False
+            if cache_key:
+                image_cache.record('MISS')
+                store = r.status_code == 200 and ttl is not None and bool(ttl > 0 or etag)
+                await start_response(send, r.status_code, response_headers + [('X-Cache', 'MISS')])
+            else:
+                await start_response(send, r.status_code, response_headers)
+
+            fd, tmp_path = image_cache.temp_body() if store else (None, None)
+            try:
+                # Writes of the cached body go to the page cache and don't wait on the disk
+                with os.fdopen(fd, 'wb') if store else nullcontext() as f:
+                    size = 0
+                    async for chunk in r.aiter_raw():
+                        if f:
+                            f.write(chunk)
+                        if shared_body is not None:
+                            size += len(chunk)
+                            if size <= image_cache.share_limit:
+                                shared_body.append(chunk)
+                            else:
+                                shared_body = None
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                if shared_body is not None:
+                    meta = image_cache.response_meta(r.status_code, response_headers, etag, ttl)
+                    await run_blocking(release, (meta, b''.join(shared_body)))
+                if store:
+                    # Moves the body in place and may scan the whole cache directory for eviction
+                    await run_blocking(image_cache.commit, cache_key, tmp_path, r.status_code, response_headers, etag, ttl)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            try:
+                # Returns the connection to the pool
+                await r.aclose()
+            finally:
+                backends.release(backend, r.status_code < 500)
+
+
+async def run_blocking(func, *args):
+    """ Runs blocking file system work in the default thread pool instead of on the event loop """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def start_response(send, status: int, headers: Headers):
+    headers = list(headers)
+    names = {name.lower() for name, _ in headers}
+    headers.extend((name, value) for name, value in CORS_HEADERS if name.lower() not in names)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.encode('latin-1'), str(value).encode('latin-1')) for name, value in headers]})
+
+
+async def send_response(send, status: int, headers: Headers, body: bytes = b''):
+    await start_response(send, status, headers + [('Content-Length', str(len(body)))])
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_cached(send, request_headers: dict, meta: dict, body: Union[BinaryIO, bytes], cache_status: str):
+    """ Same as cached_image_response of the flask views """
+    image_cache.record(cache_status)
+    headers = [(name, value) for name, value in meta['headers']] + [('X-Cache', cache_status)]
+    if meta['etag'] and parse_etags(request_headers.get('if-none-match')).contains_raw(meta['etag']):
+        if not isinstance(body, bytes):
+            body.close()
+        await start_response(send, 304, headers)
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if isinstance(body, bytes):
+        return await send_response(send, meta['status'], headers, body)
+
+    with body:
+        await start_response(send, meta['status'], headers + [('Content-Length', str(os.fstat(body.fileno()).st_size))])
+        while True:
+            chunk = await run_blocking(body.read, 64*1024)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
@@ -1,4 +1,13 @@
 from .manifest_factory import ManifestFactoryExtended
+from .manifest_cache import ManifestCache
+from .image_cache import ImageCache
+from .image_info import ImageInfoCache
+from .pdf_jobs import PdfJobs
+from .search_cache import SearchCache
+from .sprite_cache import SpriteCache
+from .thumbnail_cache import ThumbnailCache
+from .search_client import SearchClient
+from .upstream_client import UpstreamClient
 from flask_compress import Compress
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -6,6 +15,15 @@ from flask_discoverer import Discoverer
 from appmap.flask import AppmapFlask
 
 manifest_factory = ManifestFactoryExtended()
+manifest_cache = ManifestCache()
+image_api_client = UpstreamClient('IMAGE_API')
+search_client = SearchClient()
+search_cache = SearchCache()
+image_cache = ImageCache()
+image_info_cache = ImageInfoCache()
+pdf_jobs = PdfJobs()
+sprite_cache = SpriteCache()
+thumbnail_cache = ThumbnailCache()
 #compress = Compress()
 limiter = Limiter(key_func = get_remote_address)
 discoverer = Discoverer()
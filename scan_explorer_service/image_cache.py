@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+from urllib import parse as urlparse
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import DiskStore
+
+
+class InFlight(threading.Event):
+    """ Fetch of an entry in flight, set once it is released with the response shared with the waiting requests """
+    shared: Optional[Tuple[dict, bytes]] = None
+
+
+class ImageCache:
+    """ Disk cache of image server responses.
+
+    Every entry is a body file and a json file with the status, headers,
+    upstream ETag and expiry time of the response. Both are written through
+    temporary files renamed in place, so any number of workers can share the
+    directory. The modification time of a body file is its last use, when the
+    total size of the bodies grows over the limit the least recently used
+    entries are evicted. Statistics are counted per worker process.
+
+    Concurrent fetches of the same missing entry are coalesced: the first
+    request claims the entry and fetches it, identical requests wait until it
+    is released. Within a worker the claim is an event, which also hands the
+    body of small cacheable responses to the waiting requests in memory, so
+    coalescing works without a cache directory. With the directory the claim
+    is also a lock file, identical requests of other workers wait for it and
+    are served from the cache.
+    """
+
+    def __init__(self):
+        self.meta: Optional[DiskStore] = None
+        self.bodies: Optional[DiskStore] = None
+        self.locks: Optional[DiskStore] = None
+        self.max_bytes = 0
+        self.default_ttl = 0
+        self.coalesce_timeout = 0
+        self.share_limit = 0
+        self._reset_stats()
+        self._bytes_since_check = 0
+        self._inflight: Dict[str, InFlight] = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        cache_dir = app.config.get('IMAGE_CACHE_DIR')
+        self.meta = DiskStore(cache_dir, '.json') if cache_dir else None
+        self.bodies = DiskStore(cache_dir, '.img') if cache_dir else None
+        self.locks = DiskStore(cache_dir, '.lock') if cache_dir else None
+        self.max_bytes = app.config.get('IMAGE_CACHE_SIZE_LIMIT', 1024*1024*1024)
+        self.default_ttl = app.config.get('IMAGE_CACHE_DEFAULT_TTL', 24*3600)
+        self.coalesce_timeout = app.config.get('IMAGE_CACHE_COALESCE_TIMEOUT', 10)
+        self.share_limit = app.config.get('IMAGE_CACHE_COALESCE_SHARE_LIMIT', 16*1024*1024)
+        self._reset_stats()
+        # The first store of every worker checks the size of the directory
+        self._bytes_since_check = self.max_bytes
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.revalidations = 0
+        self.stale = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.meta is not None
+
+    @staticmethod
+    def key(path: str, args: Mapping) -> str:
+        """ Normalized IIIF path and sorted query parameters """
+        path = '/'.join(part for part in urlparse.unquote(path).split('/') if part)
+        items = args.items(multi=True) if hasattr(args, 'getlist') else args.items()
+        return f'{path}?{urlparse.urlencode(sorted(items))}'
+
+    def ttl(self, headers: Mapping) -> Optional[int]:
+        """ Seconds a response may be used without revalidation, None if it must not be stored """
+        directives = {}
+        for directive in headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            directives[name.lower()] = value.strip('"')
+
+        if 'no-store' in directives or 'private' in directives or headers.get('Vary') == '*':
+            return None
+        if 'no-cache' in directives:
+            return 0
+        for name in ['s-maxage', 'max-age']:
+            if directives.get(name, '').isdigit():
+                return int(directives[name])
+        return self.default_ttl
+
+    def get(self, key: str) -> Optional[Tuple[dict, BinaryIO]]:
+        """ Metadata and open body file of a cached response """
+        data = self.meta.get(key)
+        if data is None:
+            return None
+        try:
+            body = open(self.bodies.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(self.bodies.path(key))
+        except FileNotFoundError:
+            pass
+        return json.loads(data), body
+
+    @staticmethod
+    def is_fresh(meta: dict) -> bool:
+        return meta['expires'] > time.time()
+
+    def refresh(self, key: str, meta: dict, headers: Mapping):
+        """ Extends the expiry of an entry after the image server confirmed it is unchanged """
+        ttl = self.ttl(headers)
+        meta['expires'] = time.time() + (ttl or 0)
+        meta['etag'] = headers.get('ETag', meta['etag'])
+        self.meta.set(key, json.dumps(meta).encode('utf-8'))
+
+    def store(self, key: str, status: int, headers: List[Tuple[str, str]], etag: Optional[str], ttl: int,
+              chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """ Passes the body chunks through and stores the response once the body is complete """
+        fd, tmp_path = self.temp_body()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            self.commit(key, tmp_path, status, headers, etag, ttl)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def temp_body(self) -> Tuple[int, str]:
+        """ Open file descriptor and path of a temporary file for a body being stored """
+        return tempfile.mkstemp(dir=self.bodies.directory, prefix='.tmp-')
+
+    def commit(self, key: str, tmp_path: str, status: int, headers: List[Tuple[str, str]], etag: Optional[str],
+               ttl: int):
+        """ Moves a completely written temporary body in place and stores the metadata of the response """
+        size = os.path.getsize(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.bodies.path(key))
+
+        meta = self.response_meta(status, headers, etag, ttl)
+        self.meta.set(key, json.dumps(meta).encode('utf-8'))
+        with self._lock:
+            self.stores += 1
+        self.evict(size)
+
+    def acquire(self, key: str) -> bool:
+        """ Claims the fetch of an entry, False if an identical fetch is already in flight in any worker """
+        if not self.coalesce_timeout:
+            return True
+        with self._lock:
+            if key in self._inflight:
+                return False
+            self._inflight[key] = InFlight()
+        if self.locks is None:
+            return True
+
+        path = self.locks.path(key)
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                return True
+            except FileExistsError:
+                try:
+                    if os.path.getmtime(path) + self.coalesce_timeout > time.time():
+                        break
+                    # The worker holding the lock died or its client never read the response
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        with self._lock:
+            self._inflight.pop(key).set()
+        return False
+
+    def release(self, key: str, shared: Optional[Tuple[dict, bytes]] = None):
+        """ Releases an entry claimed by acquire and wakes up the requests waiting for it.
+
+        shared is the metadata and complete body of a fresh response the waiting requests of this worker are served.
+        """
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is None:
+            return
+        if self.locks:
+            try:
+                os.remove(self.locks.path(key))
+            except FileNotFoundError:
+                pass
+        event.shared = shared
+        event.set()
+
+    @staticmethod
+    def shareable(status: int, ttl: Optional[int]) -> bool:
+        """ Whether waiting requests can be served a response, otherwise they have to fetch their own """
+        return status == 200 and ttl is not None and ttl > 0
+
+    @staticmethod
+    def response_meta(status: int, headers: List[Tuple[str, str]], etag: Optional[str], ttl: int) -> dict:
+        """ Metadata of a response as stored with its body """
+        return {'status': status, 'headers': headers, 'etag': etag, 'expires': time.time() + ttl}
+
+    def wait(self, key: str) -> Optional[Tuple[dict, bytes]]:
+        """ Waits until an entry claimed by another request is released, at most for the coalesce timeout.
+
+        Returns the response shared by a request of this worker, if any.
+        """
+        deadline = time.time() + self.coalesce_timeout
+        with self._lock:
+            event = self._inflight.get(key)
+        if event:
+            event.wait(self.coalesce_timeout)
+        while self.locks and os.path.exists(self.locks.path(key)) and time.time() < deadline:
+            time.sleep(0.05)
+        return event.shared if event else None
+
+    async def wait_async(self, key: str) -> Optional[Tuple[dict, bytes]]:
+        """ Same as wait, without blocking the event loop """
+        deadline = time.time() + self.coalesce_timeout
+        with self._lock:
+            event = self._inflight.get(key)
+        while ((event and not event.is_set()) or (self.locks and os.path.exists(self.locks.path(key)))) \
+                and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        return event.shared if event else None
+
+    def evict(self, written: int = 0):
+        """ Removes the least recently used entries once the bodies exceed the size limit.
+
+        The directory is only scanned after every 5% of the limit written by this worker.
+        """
+        with self._lock:
+            self._bytes_since_check += written
+            if self._bytes_since_check < self.max_bytes // 20:
+                return
+            self._bytes_since_check = 0
+
+        entries = []
+        with os.scandir(self.bodies.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.bodies.suffix) and not entry.name.startswith('.tmp-'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        # Evict below the limit so the next stores don't immediately trigger another scan
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            for file in [path, path[:-len(self.bodies.suffix)] + self.meta.suffix]:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def record(self, cache_status: str):
+        """ Counts the outcome of a lookup, HIT, COALESCED, REVALIDATED, STALE or MISS """
+        with self._lock:
+            if cache_status == 'HIT':
+                self.hits += 1
+            elif cache_status == 'COALESCED':
+                self.coalesced += 1
+            elif cache_status == 'REVALIDATED':
+                self.revalidations += 1
+            elif cache_status == 'STALE':
+                self.stale += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            served = self.hits + self.coalesced + self.revalidations + self.stale
+            lookups = served + self.misses
+            return {'hits': self.hits, 'coalesced': self.coalesced, 'revalidations': self.revalidations, 'stale': self.stale,
+                    'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions,
+                    'hit_ratio': served / lookups if lookups else 0.0}
@@ -0,0 +1,57 @@
+import math
+from typing import Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import TTLCache
+
+# Capabilities of the image server, as advertised in its own info.json responses
+IMAGE_FORMATS = ['jpg', 'tif', 'png', 'gif']
+IMAGE_QUALITIES = ['bitonal', 'color', 'gray', 'default']
+IMAGE_SUPPORTS = ['baseUriRedirect', 'canonicalLinkHeader', 'cors', 'jsonldMediaType', 'mirroring',
+                  'profileLinkHeader', 'regionByPct', 'regionByPx', 'regionSquare', 'rotationArbitrary',
+                  'rotationBy90s', 'sizeByConfinedWh', 'sizeByDistortedWh', 'sizeByH', 'sizeByPct',
+                  'sizeByW', 'sizeByWh']
+
+
+def image_info(id: str, width: int, height: int, context: str, profile: str, tile_size: int) -> dict:
+    """ IIIF Image API 2 info.json of an image with the given dimensions """
+    scale_factors = [1]
+    while math.ceil(max(width, height) / scale_factors[-1]) > tile_size:
+        scale_factors.append(scale_factors[-1] * 2)
+
+    return {
+        '@context': context,
+        '@id': id,
+        'protocol': 'http://iiif.io/api/image',
+        'width': width,
+        'height': height,
+        'sizes': [{'width': math.ceil(width / factor), 'height': math.ceil(height / factor)}
+                  for factor in reversed(scale_factors)],
+        'tiles': [{'width': tile_size, 'height': tile_size, 'scaleFactors': scale_factors}],
+        'profile': [profile, {'formats': IMAGE_FORMATS, 'qualities': IMAGE_QUALITIES, 'supports': IMAGE_SUPPORTS}]
+    }
+
+
+class ImageInfoCache:
+    """ In-process cache of serialized info.json responses by image server path.
+
+    The metadata updates invalidate the paths of the changed pages, entries
+    of other workers expire after the ttl.
+    """
+
+    def __init__(self):
+        self.memory = TTLCache(0)
+        self.tile_size = 512
+
+    def init_app(self, app: Flask):
+        self.memory = TTLCache(app.config.get('IMAGE_INFO_CACHE_SIZE', 0), app.config.get('IMAGE_INFO_CACHE_TTL', 3600))
+        self.tile_size = app.config.get('IMAGE_INFO_TILE_SIZE', self.tile_size)
+
+    def get(self, image_path: str) -> Optional[bytes]:
+        return self.memory.get(image_path)
+
+    def set(self, image_path: str, info: bytes):
+        self.memory.set(image_path, info)
+
+    def invalidate(self, *image_paths: str):
+        for image_path in image_paths:
+            self.memory.pop(image_path)
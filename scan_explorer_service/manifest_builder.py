@@ -0,0 +1,101 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from scan_explorer_service.manifest_factory import ManifestFactoryExtended, SEARCH_CONTEXT, SEARCH_PROFILE, abstract_links
+from scan_explorer_service.models import Page
+from scan_explorer_service.utils.json_utils import LazyList
+
+
+class ManifestBuilder:
+    """ Fast path manifest builder.
+
+    Creates the same manifest json as ManifestFactoryExtended directly from
+    the row tuples of item_manifest_rows, without creating and validating an
+    iiif_prezi object for every canvas, annotation and image. The urls are
+    prepared once from the base uris currently set on the factory.
+    """
+
+    def __init__(self, factory: ManifestFactoryExtended):
+        base = factory.prezi_base
+        self.context = factory.context_uri
+        self.manifest_url = base + '{}/manifest.json'
+        self.canvas_url = base + 'canvas/{}.json'
+        self.annotation_url = base + 'annotation/{}.json'
+        self.range_url = base + 'range/{}.json'
+        self.image_base = factory.default_base_image_uri + '/'
+        self.image_context = factory.default_image_api_context
+        self.image_profile = factory.default_image_api_profile
+
+    def manifest(self, item_id: str, pages: List[Tuple], links: List[Tuple], search_url: str,
+                 lazy: bool = False, article_id: Optional[str] = None,
+                 path: Optional[str] = None, label: Optional[str] = None) -> dict:
+        """ Creates the manifest json, with ranges only for article_id if it is set.
+
+        The manifest is published at the path of the item unless another path is given.
+        """
+        page_links: Dict[str, List[Tuple]] = defaultdict(list)
+        for page_id, link_article_id, bibcode in links:
+            page_links[page_id].append((link_article_id, bibcode))
+
+        # Ranges in order of their first page, the same order as ManifestFactoryExtended.create_ranges
+        article_canvases: Dict[Tuple, List[str]] = {}
+        for page in pages:
+            for article in page_links[page.id]:
+                if article_id is None or article[0] == article_id:
+                    article_canvases.setdefault(article, []).append(self.canvas_url.format(page.id))
+
+        directories = {}
+        def canvas(page):
+            key = (page.type, page.journal, page.volume)
+            if key not in directories:
+                directories[key] = Page.image_directory(*key)
+            return self.canvas(page, directories[key], page_links[page.id])
+
+        canvases = LazyList(pages, canvas) if lazy else [canvas(page) for page in pages]
+        ranges = [self.range(bibcode, canvases) for (_, bibcode), canvases in article_canvases.items()]
+
+        manifest = {
+            '@context': self.context,
+            '@id': self.manifest_url.format(path or item_id),
+            '@type': 'sc:Manifest',
+            'label': label or item_id,
+            'description': item_id,
+            'sequences': [{'@type': 'sc:Sequence', 'canvases': canvases}]
+        }
+        if ranges:
+            manifest['structures'] = ranges
+        manifest['service'] = {'@context': SEARCH_CONTEXT, '@id': search_url, 'profile': SEARCH_PROFILE}
+        return manifest
+
+    def canvas(self, page: Tuple, image_directory: str, articles: List[Tuple]) -> dict:
+        canvas_id = self.canvas_url.format(page.id)
+        label = f'p. {page.label}'
+        image_path = Page.image_path_in(image_directory, page.name, page.color_type)
+        image_url = self.image_base + image_path
+
+        canvas = {'@id': canvas_id, '@type': 'sc:Canvas', 'label': label}
+        if articles:
+            canvas['metadata'] = [{'label': 'Abstract', 'value': abstract_links(bibcode for _, bibcode in articles)}]
+        canvas['height'] = page.height
+        canvas['width'] = page.width
+        canvas['images'] = [{
+            '@id': self.annotation_url.format(page.id),
+            '@type': 'oa:Annotation',
+            'motivation': 'sc:painting',
+            'resource': {
+                '@id': f'{image_url}/full/full/0/{Page.color_quality(page.color_type)}.tif',
+                '@type': 'dctypes:Image',
+                'label': label,
+                'format': page.format,
+                'height': page.height,
+                'width': page.width,
+                'service': {'@context': self.image_context, '@id': image_url, 'profile': self.image_profile}
+            },
+            'on': canvas_id
+        }]
+        return canvas
+
+    def range(self, bibcode: str, canvases: List[str]) -> dict:
+        range = {'@id': self.range_url.format(bibcode), '@type': 'sc:Range', 'label': bibcode}
+        if canvases:
+            range['canvases'] = canvases
+        return range
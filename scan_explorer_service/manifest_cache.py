@@ -0,0 +1,111 @@
+import os
+from typing import Iterable, Iterator, Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import DiskStore, LRUCache
+
+
+class ManifestCache:
+    """ Cache of serialized manifests.
+
+    Entries are stored per item id together with a version string, usually
+    derived from the items updated timestamp. A lookup with a different
+    version is a miss, so a stale manifest is never served even if another
+    worker did the invalidation. The in-process LRU is backed by an optional
+    on-disk store shared between workers.
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(0)
+        self.disk: Optional[DiskStore] = None
+        self.stream_limit = 16*1024*1024
+
+    def init_app(self, app: Flask):
+        self.memory = LRUCache(app.config.get('MANIFEST_CACHE_SIZE', 0))
+        cache_dir = app.config.get('MANIFEST_CACHE_DIR')
+        self.disk = DiskStore(cache_dir, '.json') if cache_dir else None
+        self.stream_limit = app.config.get('MANIFEST_CACHE_STREAM_LIMIT', self.stream_limit)
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.max_entries > 0 or self.disk is not None
+
+    def get(self, id: str, version: str) -> Optional[bytes]:
+        entry = self.memory.get(id)
+        if entry and entry[0] == version:
+            return entry[1]
+
+        if self.disk:
+            data = self.disk.get(id)
+            if data:
+                disk_version, _, body = data.partition(b'\n')
+                if disk_version.decode('utf-8') == version:
+                    self.memory.set(id, (version, body))
+                    return body
+        return None
+
+    def contains(self, id: str, version: str) -> bool:
+        """ Whether the manifest is cached with this version, without reading the body from disk """
+        entry = self.memory.get(id)
+        if entry and entry[0] == version:
+            return True
+
+        if self.disk:
+            try:
+                with open(self.disk.path(id), 'rb') as f:
+                    return f.readline().rstrip(b'\n').decode('utf-8') == version
+            except FileNotFoundError:
+                return False
+        return False
+
+    def set(self, id: str, version: str, body: bytes):
+        self.memory.set(id, (version, body))
+        if self.disk:
+            self.disk.set(id, version.encode('utf-8') + b'\n' + body)
+
+    def set_from_stream(self, id: str, version: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """ Passes the chunks through and caches the body once it has been fully produced.
+
+        The chunks are written to the disk store as they are produced, only
+        bodies up to stream_limit bytes are also collected for the in-process
+        cache, so streaming a large manifest doesn't hold it in memory.
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+
+        body = [] if self.memory.max_entries > 0 else None
+        size = 0
+        f, tmp_path = None, None
+        if self.disk:
+            fd, tmp_path = self.disk.temp_file()
+            f = os.fdopen(fd, 'wb')
+            f.write(version.encode('utf-8') + b'\n')
+        try:
+            for chunk in chunks:
+                if f:
+                    f.write(chunk)
+                if body is not None:
+                    size += len(chunk)
+                    if size > self.stream_limit:
+                        body = None
+                    else:
+                        body.append(chunk)
+                yield chunk
+
+            if body is not None:
+                self.memory.set(id, (version, b''.join(body)))
+            if f:
+                f.close()
+                f = None
+                self.disk.commit(id, tmp_path)
+        finally:
+            if f:
+                f.close()
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def invalidate(self, *ids: str):
+        for id in ids:
+            self.memory.pop(id)
+            if self.disk:
+                self.disk.delete(id)
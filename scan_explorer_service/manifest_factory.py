@@ -1,8 +1,17 @@
-from typing import Dict, Iterable
+from typing import Dict, Iterable, List, Optional, Tuple
 from iiif_prezi.factory import ManifestFactory, Sequence, Canvas, Image, Annotation, Manifest, Range
 from scan_explorer_service.models import Article, Page, Collection
+from scan_explorer_service.utils.cache_utils import LRUCache
+from scan_explorer_service.utils.json_utils import LazyList
 from typing import Union
-from itertools import chain
+
+SEARCH_CONTEXT = 'http://iiif.io/api/search/1/context.json'
+SEARCH_PROFILE = 'http://iiif.io/api/search/1/search'
+
+
+def abstract_links(bibcodes: Iterable[str]) -> str:
+    return ''.join(f'<a href="https://ui.adsabs.harvard.edu/abs/{str(b)}/abstract">{str(b)}</a><br/>' for b in bibcodes)
+
 
 class ManifestFactoryExtended(ManifestFactory):
     """ Extended manifest factory.
@@ -11,47 +20,74 @@ class ManifestFactoryExtended(ManifestFactory):
     functions used to create manifest objects from model.
     """
 
-    def create_manifest(self, item: Union[Article, Collection]):
+    def create_manifest(self, item: Union[Article, Collection], pages: Optional[List[Page]] = None,
+                        path: Optional[str] = None, label: Optional[str] = None):
+        pages = item.pages if pages is None else pages
         manifest = self.manifest(
-            ident=f'{item.id}/manifest.json', label=item.id)
+            ident=f'{path or item.id}/manifest.json', label=label or item.id)
         manifest.description = item.id
-        manifest.add_sequence(self.create_sequence(item))
-        for range in self.create_range(item):
+        sequence = self.create_sequence(item, pages)
+        manifest.add_sequence(sequence)
+        for range in self.create_ranges(item, pages, sequence.canvases):
             manifest.add_range(range)
         
         return manifest
 
-    def create_sequence(self, item: Union[Article, Collection]):
+    def create_collection(self, item: Union[Article, Collection], manifests: List[Tuple[str, str]]):
+        """ Creates an IIIF collection of the item from (path, label) of its manifests """
+        collection = self.collection(ident=f'{item.id}/collection', label=item.id)
+        collection.description = item.id
+        for path, label in manifests:
+            collection.manifest(ident=f'{path}/manifest.json', label=label)
+
+        return collection
+
+    def create_sequence(self, item: Union[Article, Collection], pages: Optional[List[Page]] = None):
         sequence: Sequence = self.sequence()
-        for page in item.pages:
+        for page in (item.pages if pages is None else pages):
             sequence.add_canvas(self.get_or_create_canvas(page))
 
         return sequence
 
-    def create_range(self, item: Union[Article, Collection]):
-        if isinstance(item, Collection):
-            return list(chain(*[self.create_range(article) for article in item.articles]))
+    def create_ranges(self, item: Union[Article, Collection], pages: List[Page], canvases: List[Canvas]):
+        """ Creates the article ranges from the already loaded articles of the pages,
+        reusing the sequence canvases. Ranges are ordered by their first page. """
+        ranges: Dict[str, Range] = {}
+        for page, canvas in zip(pages, canvases):
+            for article in page.articles:
+                if isinstance(item, Article) and article.id != item.id:
+                    continue
+                if article.id not in ranges:
+                    ranges[article.id] = self.range(ident=article.bibcode, label=article.bibcode)
+                ranges[article.id].add_canvas(canvas)
+
+        return list(ranges.values())
 
-        range: Range = self.range(ident=item.bibcode, label=item.bibcode)
-        for page in item.pages:
-            range.add_canvas(self.get_or_create_canvas(page))
+    def set_canvas_cache(self, max_entries: int, max_bytes: int = 0):
+        self.canvas_cache = LRUCache(max_entries, max_bytes)
 
-        return [range]
+    def get_canvas_cache(self) -> LRUCache:
+        if not hasattr(self, 'canvas_cache'):
+            self.set_canvas_cache(1000)
+        return self.canvas_cache
 
-    def get_canvas_dict(self) -> Dict[str, Canvas]:
-        if not hasattr(self, 'canvas_dict'):
-            self.canvas_dict = {}
-        return self.canvas_dict
+    def canvas_cache_stats(self) -> Dict[str, int]:
+        return self.get_canvas_cache().stats()
 
     def get_or_create_canvas(self, page: Page):
-        canvas_dict = self.get_canvas_dict()
-        if(page.id in canvas_dict.keys()):
-            return canvas_dict[page.id]
+        canvas_cache = self.get_canvas_cache()
+        # An overwritten page gets a new updated timestamp, relinked articles change the abstract
+        # links and the canvas and image ids embed the base uris, so they are all part of the key
+        key = (page.id, page.updated, tuple(article.bibcode for article in page.articles),
+               self.prezi_base, self.default_base_image_uri)
+        canvas = canvas_cache.get(key)
+        if canvas:
+            return canvas
         canvas: Canvas = self.canvas(ident=str(page.id), label=f'p. {page.label}')
 
         if len(page.articles) > 0:
             metadata = {
-                'Abstract': ''.join(f'<a href="https://ui.adsabs.harvard.edu/abs/{str(x.bibcode)}/abstract">{str(x.bibcode)}</a><br/>' for x in page.articles)
+                'Abstract': abstract_links(x.bibcode for x in page.articles)
             }
             canvas.set_metadata(metadata)
 
@@ -60,7 +96,7 @@ class ManifestFactoryExtended(ManifestFactory):
         annotation = self.create_image_annotation(page)
         annotation.on = canvas.id
         canvas.add_annotation(annotation)
-        canvas_dict[page.id] = canvas
+        canvas_cache.set(key, canvas)
         return canvas
 
     def create_image_annotation(self, page: Page):
@@ -77,8 +113,29 @@ class ManifestFactoryExtended(ManifestFactory):
 
         return annotation
 
+    def manifest_to_lazy_json(self, manifest: Manifest):
+        """ Same structure as manifest.toJSON(top=True), but sequences, canvases and
+        ranges are only serialized while the result is being encoded """
+        return self._to_lazy_json(manifest, True, {
+            'sequences': (Sequence, lambda s: self._to_lazy_json(s, False, {'canvases': (Canvas, lambda c: c.toJSON(False))})),
+            'structures': (Range, lambda r: r.toJSON(False))
+        })
+
+    def _to_lazy_json(self, resource, top: bool, lazy_properties: dict):
+        originals = {prop: getattr(resource, prop) for prop in lazy_properties.keys()}
+        try:
+            # Placeholders pass the structural validation without serializing the children
+            for prop, (cls, _) in lazy_properties.items():
+                setattr(resource, prop, [{'@type': cls._type}] if originals[prop] else [])
+            d = resource.toJSON(top)
+        finally:
+            for prop, items in originals.items():
+                setattr(resource, prop, items)
+
+        for prop, (_, to_json) in lazy_properties.items():
+            if prop in d:
+                d[prop] = LazyList(originals[prop], to_json)
+        return d
+
     def add_search_service(self, manifest: Manifest, search_url: str):
-        context = 'http://iiif.io/api/search/1/context.json'
-        profile = 'http://iiif.io/api/search/1/search'
-        
-        manifest.add_service(ident=search_url, context=context, profile=profile)
+        manifest.add_service(ident=search_url, context=SEARCH_CONTEXT, profile=SEARCH_PROFILE)
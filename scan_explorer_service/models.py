@@ -155,11 +155,20 @@ class Page(Base, Timestamp):
 
     @property
     def image_path(self):
+        directory = Page.image_directory(self.collection.type, self.collection.journal, self.collection.volume)
+        return Page.image_path_in(directory, self.name, self.color_type)
+
+    @staticmethod
+    def image_directory(collection_type: str, journal: str, volume: str):
+        separator = current_app.config.get('IMAGE_API_SLASH_SUB', '%2F')
+        directory = f'bitmaps{separator}{collection_type}{separator}{journal}{separator}{volume}{separator}600'
+        return directory.replace('.', '_')
+
+    @staticmethod
+    def image_path_in(directory: str, name: str, color_type: PageColor):
         separator = current_app.config.get('IMAGE_API_SLASH_SUB', '%2F')
-        image_path = f'bitmaps{separator}{self.collection.type}{separator}{self.collection.journal}{separator}{self.collection.volume}{separator}600'
-        image_path = image_path.replace('.', '_')
-        image_path += f'{separator}{self.name}'
-        if self.color_type != PageColor.BW:
+        image_path = f'{directory}{separator}{name}'
+        if color_type != PageColor.BW:
             image_path += '.tif'
         return image_path
 
@@ -169,11 +178,15 @@ class Page(Base, Timestamp):
 
     @property
     def image_color_quality(self):
-        if self.color_type == PageColor.BW:
+        return Page.color_quality(self.color_type)
+
+    @staticmethod
+    def color_quality(color_type: PageColor):
+        if color_type == PageColor.BW:
             return "bitonal"
-        elif self.color_type == PageColor.Grayscale:
+        elif color_type == PageColor.Grayscale:
             return "gray"
-        elif self.color_type == PageColor.Color:
+        elif color_type == PageColor.Color:
             return "color"
         else:
             return "default"
@@ -1,7 +1,7 @@
-from typing import Dict, Iterator, List
-import opensearchpy
+from typing import Dict, Iterator, List, Optional
 from flask import current_app
-from scan_explorer_service.utils.search_utils import EsFields, OrderOptions
+from scan_explorer_service.extensions import search_client
+from scan_explorer_service.utils.search_utils import EsFields, OrderOptions, decode_after_token, encode_after_token
 
 def create_query_string_query(query_string: str):
     query =  {
@@ -59,6 +59,59 @@ def append_aggregate(query: dict, agg_field: EsFields, page: int, size: int, sor
 
     return query
 
+def append_composite(query: dict, agg_field: EsFields, size: int, sort: OrderOptions, after: str):
+    """Cursor paging of the aggregated ids, each page costs the same however deep it is.
+
+    A composite aggregation can only be ordered by its keys, so relevance sorting
+    needs the bucket_sort paging of append_aggregate.
+    """
+    if sort == OrderOptions.Relevance_desc or sort == OrderOptions.Relevance_asc:
+        raise Exception("%s can't be used with an after token, sort by bibcode or collection instead" % sort.value)
+
+    if "_desc" in sort.value:
+        sort_order = "desc"
+    else:
+        sort_order = "asc"
+
+    query['size'] = 0
+    query['aggs'] = {
+        "total_count": {
+            "cardinality": {
+                "field": agg_field.value
+            }
+        },
+        "ids": {
+            "composite": {
+                "size": size,
+                "sources": [{"id": {"terms": {"field": agg_field.value, "order": sort_order}}}]
+            }
+        }
+    }
+    if after:
+        query['aggs']['ids']['composite']['after'] = decode_after_token(after)
+    return query
+
+def aggregate_query(qs: str, aggregate_field: EsFields, page, limit, sort, after: Optional[str] = None):
+    """Paged by the after token if one is given, an empty token asks for the first page"""
+    query = create_query_string_query(qs)
+    if after is None:
+        return append_aggregate(query, aggregate_field, page, limit, sort)
+    return append_composite(query, aggregate_field, limit, sort, after)
+
+def next_after_token(result: dict, limit: int) -> Optional[str]:
+    """Token of the page following a result of a composite aggregation, None on the last page"""
+    ids = result['aggregations']['ids']
+    if 'after_key' not in ids or len(ids['buckets']) < limit:
+        return None
+    return encode_after_token(ids['after_key'])
+
+def flatten_composite_keys(result: dict) -> dict:
+    """Gives the buckets of a composite aggregation the plain keys of a terms aggregation"""
+    for bucket in result['aggregations']['ids']['buckets']:
+        if isinstance(bucket['key'], dict):
+            bucket['key'] = bucket['key']['id']
+    return result
+
 def append_highlight(query: dict):
     query['highlight'] = {
         "fields": {
@@ -70,11 +123,24 @@ def append_highlight(query: dict):
 
 
 def es_search(query: dict) -> Iterator[str]:
-    es = opensearchpy.OpenSearch(current_app.config.get('OPEN_SEARCH_URL'))
-    resp = es.search(index=current_app.config.get(
+    resp = search_client.client.search(index=current_app.config.get(
         'OPEN_SEARCH_INDEX'), body=query)
     return resp
 
+def es_msearch(queries: List[dict]) -> List[dict]:
+    """Runs several searches in one round trip, results are in the order of the queries"""
+    body = []
+    for query in queries:
+        body.extend([{}, query])
+    resp = search_client.client.msearch(index=current_app.config.get(
+        'OPEN_SEARCH_INDEX'), body=body)
+    results = resp['responses']
+    for result in results:
+        if 'error' in result:
+            error = result['error']
+            raise Exception(error.get('reason', error) if isinstance(error, dict) else error)
+    return results
+
 def text_search_highlight(text: str, filter_field: EsFields, filter_value: str):
     query_string = text
     if filter_field:
@@ -111,7 +177,7 @@ def set_page_search_fields(query: dict) -> dict:
     query["_source"] = {"include": ["page_id", "volume_id", "page_label", "page_number"]}
     return query
 
-def page_os_search(qs: str, page, limit, sort):
+def page_search_query(qs: str, page, limit, sort):
     query = create_query_string_query(qs)
     query = set_page_search_fields(query)
     from_number = (page - 1) * limit
@@ -132,6 +198,16 @@ def page_os_search(qs: str, page, limit, sort):
         sort_order = "asc"
 
     query['sort'] = [{sort_field:{'order': sort_order}}, {'page_number':{'order':'asc'}} ]
+    return query
+
+def page_count_query(qs: str):
+    query = create_query_string_query(qs)
+    query['size'] = 0
+    query['track_total_hits'] = True
+    return query
+
+def page_os_search(qs: str, page, limit, sort):
+    query = page_search_query(qs, page, limit, sort)
     es_result = es_search(query)
     return es_result
 
@@ -142,8 +218,24 @@ def page_ocr_os_search(collection_id: str, page_number:int):
     es_result = es_search(query)
     return es_result
 
-def aggregate_search(qs: str, aggregate_field, page, limit, sort):
+def aggregate_count_query(qs: str, aggregate_field: EsFields):
     query = create_query_string_query(qs)
-    query = append_aggregate(query, aggregate_field, page, limit, sort)
+    query['size'] = 0
+    query['aggs'] = {"total_count": {"cardinality": {"field": aggregate_field.value}}}
+    return query
+
+def aggregate_search(qs: str, aggregate_field, page, limit, sort, after: Optional[str] = None):
+    query = aggregate_query(qs, aggregate_field, page, limit, sort, after)
     es_result = es_search(query)
-    return es_result
\ No newline at end of file
+    return flatten_composite_keys(es_result)
+
+def article_os_search(qs: str, page, limit, sort, after: Optional[str] = None):
+    """Article search together with the collection and page counts shown when no article matches.
+
+    The counts are requested speculatively in the same multi search, so a search
+    without articles takes a single round trip.
+    """
+    query = aggregate_query(qs, EsFields.article_id, page, limit, sort, after)
+    result, collection_result, page_result = es_msearch([
+        query, aggregate_count_query(qs, EsFields.volume_id), page_count_query(qs)])
+    return flatten_composite_keys(result), collection_result['aggregations']['total_count']['value'], page_result['hits']['total']['value']
\ No newline at end of file
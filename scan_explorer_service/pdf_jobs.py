@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import atomic_write
+
+
+class PdfJobs:
+    """ Background pdf exports.
+
+    A job is identified by a hash of its parameters, so identical requests
+    share one job. Every job has a json status file and, once done, a pdf
+    file in the job directory, which makes the status and results visible
+    to all workers. Jobs are created with an exclusive file create, so only
+    one worker builds a job, in its local thread pool. Finished jobs are
+    removed after the ttl, queued or running jobs which were not updated
+    within the timeout are considered lost and can be submitted again.
+    """
+
+    def __init__(self):
+        self.app: Optional[Flask] = None
+        self.directory: Optional[str] = None
+        self.workers = 2
+        self.ttl = 24*3600
+        self.timeout = 3600
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        self.app = app
+        self.directory = app.config.get('PDF_JOB_DIR') or os.path.join(tempfile.gettempdir(), 'scan_explorer_pdf_jobs')
+        self.workers = app.config.get('PDF_JOB_WORKERS', self.workers)
+        self.ttl = app.config.get('PDF_JOB_TTL', self.ttl)
+        self.timeout = app.config.get('PDF_JOB_TIMEOUT', self.timeout)
+        self._executor = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # Threads of the parent process are gone after a fork
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pdf-job')
+            self._pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def job_id(*params) -> str:
+        return hashlib.sha1('|'.join(str(param) for param in params).encode('utf-8')).hexdigest()
+
+    def status_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f'{job_id}.pdf')
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """ Status of a job, None if it does not exist or has expired """
+        try:
+            with open(self.status_path(job_id), 'r') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        try:
+            status = json.loads(data)
+        except ValueError:
+            # The status of a job which is just being created
+            status = {'id': job_id, 'status': 'queued', 'created': now, 'updated': now}
+        if status['status'] in ['done', 'failed'] and status['updated'] + self.ttl < now:
+            self.remove(job_id)
+            return None
+        if status['status'] in ['queued', 'running'] and status['updated'] + self.timeout < now:
+            status.update(status='failed', error='Job timed out')
+        return status
+
+    def submit(self, job_id: str, build: Callable[[BinaryIO], None]) -> dict:
+        """ Returns the status of the job, starting it unless it is already queued, running or done.
+
+        build writes the pdf to the given file and is called in an application context.
+        """
+        self.remove_expired()
+        with self._lock:
+            status = self.status(job_id)
+            if status and status['status'] != 'failed':
+                return status
+            if status:
+                self.remove(job_id)
+
+            now = time.time()
+            status = {'id': job_id, 'status': 'queued', 'created': now, 'updated': now}
+            try:
+                with open(self.status_path(job_id), 'x') as f:
+                    f.write(json.dumps(status))
+            except FileExistsError:
+                # Another worker created the job in the meantime
+                return self.status(job_id) or status
+
+        self.executor.submit(self._run, job_id, build, now)
+        return status
+
+    def _run(self, job_id: str, build: Callable[[BinaryIO], None], created: float):
+        self._set_status(job_id, 'running', created)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with self.app.app_context(), os.fdopen(fd, 'wb') as f:
+                build(f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.result_path(job_id))
+            self._set_status(job_id, 'done', created, size=os.path.getsize(self.result_path(job_id)))
+        except Exception as e:
+            self.app.logger.exception('Pdf job %s failed', job_id)
+            self._set_status(job_id, 'failed', created, error=str(e))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _set_status(self, job_id: str, state: str, created: float, **values):
+        status = {'id': job_id, 'status': state, 'created': created, 'updated': time.time(), **values}
+        atomic_write(self.status_path(job_id), json.dumps(status).encode('utf-8'))
+
+    def remove(self, job_id: str):
+        for path in [self.result_path(job_id), self.status_path(job_id)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove_expired(self):
+        with os.scandir(self.directory) as it:
+            job_ids = [entry.name[:-len('.json')] for entry in it if entry.name.endswith('.json')]
+        for job_id in job_ids:
+            # Expired jobs are removed by the status lookup
+            self.status(job_id)
@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import time
+from typing import Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import DiskStore, LRUCache, atomic_write
+from scan_explorer_service.utils.search_utils import OrderOptions
+
+
+class SearchCache:
+    """ Cache of serialized search responses.
+
+    Entries are keyed on the endpoint and the translated query string with
+    the paging and sorting options, so differently written but equivalent
+    queries share an entry. They expire after the ttl. The in-process LRU is
+    backed by an optional on-disk store shared between workers. A flush,
+    usually after a reindex, also drops the entries other workers keep in
+    memory when the disk store is used, otherwise they expire after the ttl.
+    Expired entries are removed from disk when they are read, the least
+    recently used once the store exceeds its size limit.
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(0)
+        self.disk: Optional[DiskStore] = None
+        self.ttl = 300
+        self._flushed = 0.0
+
+    def init_app(self, app: Flask):
+        self.memory = LRUCache(app.config.get('SEARCH_CACHE_SIZE', 0))
+        self.ttl = app.config.get('SEARCH_CACHE_TTL', self.ttl)
+        cache_dir = app.config.get('SEARCH_CACHE_DIR')
+        max_bytes = app.config.get('SEARCH_CACHE_DIR_SIZE_LIMIT', 256*1024*1024)
+        self.disk = DiskStore(cache_dir, '.json', max_bytes) if cache_dir else None
+        self._flushed = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and (self.memory.max_entries > 0 or self.disk is not None)
+
+    @staticmethod
+    def key(endpoint: str, qs: str, page: int, limit: int, sort: OrderOptions, after: Optional[str] = None) -> str:
+        return json.dumps([endpoint, normalize_query(qs), page, limit, sort.value, after])
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        flushed = self.flushed()
+        entry = self.memory.get(key)
+        if entry and entry[1] > now and entry[2] > flushed:
+            return entry[0]
+
+        if self.disk:
+            data = self.disk.get(key)
+            if data is None:
+                return None
+            header, _, body = data.partition(b'\n')
+            created, expires = (float(value) for value in header.split())
+            if expires > now and created > flushed:
+                self.memory.set(key, (body, expires, created))
+                return body
+            self.disk.delete(key)
+        return None
+
+    def set(self, key: str, body: bytes):
+        now = time.time()
+        expires = now + self.ttl
+        self.memory.set(key, (body, expires, now))
+        if self.disk:
+            self.disk.set(key, f'{now} {expires}'.encode('utf-8') + b'\n' + body)
+
+    def flushed(self) -> float:
+        """ Time of the last flush, of any worker sharing the disk store """
+        if self.disk:
+            try:
+                with open(self._marker_path(), 'rb') as f:
+                    return max(self._flushed, float(f.read()))
+            except FileNotFoundError:
+                pass
+        return self._flushed
+
+    def flush(self):
+        self._flushed = time.time()
+        self.memory.clear()
+        if self.disk:
+            atomic_write(self._marker_path(), str(self._flushed).encode('utf-8'))
+            for entry in os.scandir(self.disk.directory):
+                if entry.name.endswith(self.disk.suffix):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def stats(self) -> dict:
+        return self.memory.stats()
+
+    def _marker_path(self) -> str:
+        return os.path.join(self.disk.directory, 'flushed')
+
+
+def normalize_query(qs: str) -> str:
+    """ Collapses whitespace outside of quoted phrases, which are matched as written """
+    parts = re.split(r'("[^"]*")', qs)
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)).strip()
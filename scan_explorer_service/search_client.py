@@ -0,0 +1,42 @@
+import os
+import threading
+from typing import Optional
+import opensearchpy
+from flask import Flask
+
+
+class SearchClient:
+    """ OpenSearch client shared by all threads of a worker process.
+
+    The client keeps a pool of keep-alive connections to every host and is
+    created on first use, after a fork every process creates its own. Hosts,
+    pool size, timeout and retries are read from the OPEN_SEARCH config
+    settings.
+    """
+
+    def __init__(self):
+        self.hosts = []
+        self.pool_size = 10
+        self.timeout = 10
+        self.max_retries = 3
+        self.retry_on_timeout = True
+        self._client: Optional[opensearchpy.OpenSearch] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        self.hosts = app.config.get('OPEN_SEARCH_HOSTS') or [app.config.get('OPEN_SEARCH_URL')]
+        self.pool_size = app.config.get('OPEN_SEARCH_POOL_SIZE', self.pool_size)
+        self.timeout = app.config.get('OPEN_SEARCH_TIMEOUT', self.timeout)
+        self.max_retries = app.config.get('OPEN_SEARCH_MAX_RETRIES', self.max_retries)
+        self.retry_on_timeout = app.config.get('OPEN_SEARCH_RETRY_ON_TIMEOUT', self.retry_on_timeout)
+        self._client = None
+
+    @property
+    def client(self) -> opensearchpy.OpenSearch:
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = opensearchpy.OpenSearch(self.hosts, maxsize=self.pool_size, timeout=self.timeout,
+                                                       max_retries=self.max_retries, retry_on_timeout=self.retry_on_timeout)
+                self._pid = os.getpid()
+            return self._client
@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+from typing import Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import DiskStore
+
+
+class SpriteCache:
+    """ Disk cache of generated page sprites.
+
+    Every sprite is a jpeg and a json map of the page offsets, stored under
+    the same key. The map carries the version of the collection the sprite
+    was generated from, a sprite of an older version is a miss and is
+    replaced when it is generated again. Once the images exceed the size
+    limit the least recently used are evicted, a map without its image is a
+    miss as well.
+    """
+
+    def __init__(self):
+        self.images: Optional[DiskStore] = None
+        self.maps: Optional[DiskStore] = None
+
+    def init_app(self, app: Flask):
+        directory = app.config.get('SPRITE_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'scan_explorer_sprites')
+        self.images = DiskStore(directory, '.jpg', app.config.get('SPRITE_CACHE_SIZE_LIMIT', 1024*1024*1024))
+        self.maps = DiskStore(directory, '.json')
+
+    def get(self, key: str, version: str) -> Optional[dict]:
+        data = self.maps.get(key)
+        if data is None:
+            return None
+        sprite_map = json.loads(data)
+        if sprite_map['version'] != version or not os.path.exists(self.images.path(key)):
+            return None
+        self.images.touch(key)
+        return sprite_map
+
+    def set(self, key: str, version: str, image: bytes, sprite_map: dict):
+        # The image is written first, so a map is never found without its image
+        self.images.set(key, image)
+        self.maps.set(key, json.dumps({**sprite_map, 'version': version}).encode('utf-8'))
+
+    def image_path(self, key: str) -> str:
+        return self.images.path(key)
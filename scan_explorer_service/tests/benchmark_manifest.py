@@ -0,0 +1,80 @@
+""" Benchmark of the iiif_prezi manifest factory against the fast path manifest builder.
+
+Builds manifests for synthetic volumes in memory, no database is needed.
+
+    python -m scan_explorer_service.tests.benchmark_manifest
+"""
+import json
+import time
+from collections import namedtuple
+from scan_explorer_service.app import create_app
+from scan_explorer_service.manifest_builder import ManifestBuilder
+from scan_explorer_service.manifest_factory import ManifestFactoryExtended
+from scan_explorer_service.models import Article, Collection, Page, PageColor
+
+PageRow = namedtuple('PageRow', ['id', 'name', 'label', 'format', 'color_type', 'width', 'height', 'type', 'journal', 'volume'])
+PAGES_PER_ARTICLE = 10
+
+
+def synthetic_volume(n_pages: int):
+    collection = Collection(type='seri', journal='ApJ..', volume='0333')
+    articles = [Article(bibcode=f'1988ApJ...333.{n:04d}R', collection_id=collection.id)
+                for n in range(0, n_pages, PAGES_PER_ARTICLE)]
+    pages = []
+    for n in range(n_pages):
+        page = Page(name=f'{n:07d}.000', label=str(n + 1), format='image/tiff', color_type=PageColor.Grayscale,
+                    width=2000, height=3000, collection_id=collection.id, volume_running_page_num=n + 1)
+        page.collection = collection
+        page.articles = [articles[n // PAGES_PER_ARTICLE]]
+        pages.append(page)
+    return collection, articles, pages
+
+
+def prezi_manifest(factory: ManifestFactoryExtended, collection, articles, pages, search_url):
+    manifest = factory.create_manifest(collection, pages)
+    factory.add_search_service(manifest, search_url)
+    return manifest.toJSON(top=True)
+
+
+def volume_rows(collection, articles, pages):
+    """ Row tuples as returned by item_manifest_rows """
+    rows = [PageRow(p.id, p.name, p.label, p.format, p.color_type, p.width, p.height,
+                    collection.type, collection.journal, collection.volume) for p in pages]
+    links = [(p.id, a.id, a.bibcode) for p in pages for a in p.articles]
+    return rows, links
+
+
+def timed(fn, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    app = create_app()
+    with app.test_request_context():
+        factory = ManifestFactoryExtended()
+        factory.set_iiif_image_info(2.0, 2)
+        factory.set_debug('error')
+        factory.set_base_prezi_uri('https://example.org/v1/scan/manifest')
+        factory.set_base_image_uri('https://example.org/v1/scan/image/iiif/2')
+        search_url = 'https://example.org/v1/scan/manifest/search'
+
+        print(f'{"pages":>8} {"prezi (s)":>12} {"fast (s)":>12} {"speedup":>8}')
+        for n_pages in [100, 1000, 10000]:
+            volume = synthetic_volume(n_pages)
+            # Measure cold builds, the canvas cache would otherwise hide the cost after the first run
+            factory.set_canvas_cache(0)
+            prezi_time, prezi_json = timed(lambda: prezi_manifest(factory, *volume, search_url))
+            rows = volume_rows(*volume)
+            fast_time, fast_json = timed(lambda: ManifestBuilder(factory).manifest(volume[0].id, *rows, search_url))
+
+            assert json.dumps(prezi_json) == json.dumps(fast_json), 'Builders produced different manifests'
+            print(f'{n_pages:>8} {prezi_time:>12.4f} {fast_time:>12.4f} {prezi_time / fast_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
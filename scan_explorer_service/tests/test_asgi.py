@@ -0,0 +1,186 @@
+import asyncio
+import json
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import httpx
+from scan_explorer_service.tests.base import TestCaseDatabase
+from scan_explorer_service.asgi import AsyncImageProxy
+from scan_explorer_service.extensions import image_api_client, image_cache, thumbnail_cache
+
+
+def asgi_request(app, path: str, query: bytes = b'', headers=()):
+    return asyncio.run(asgi_call(app, path, query, headers))
+
+
+async def asgi_call(app, path: str, query: bytes = b'', headers=()):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query,
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'server': ('localhost', 8181), 'client': ('127.0.0.1', 1234)}
+    await app(scope, receive, send)
+
+    response_headers = {name.decode(): value.decode() for name, value in messages[0]['headers']}
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return messages[0]['status'], response_headers, body
+
+
+class TestAsgi(TestCaseDatabase):
+
+    def create_app(self):
+        from scan_explorer_service.app import create_app
+        return create_app(**{
+            'SQLALCHEMY_DATABASE_URI': self.postgresql_url,
+            'OPEN_SEARCH_URL': 'http://localhost:1234',
+            'OPEN_SEARCH_INDEX': 'test',
+            'SQLALCHEMY_ECHO': False,
+            'TESTING': True,
+            'PROPAGATE_EXCEPTIONS': True,
+            'TRAP_BAD_REQUEST_ERRORS': True,
+            'PRESERVE_CONTEXT_ON_EXCEPTION': False
+        })
+
+    def setUp(self):
+        self.requests = []
+
+        def handler(request: httpx.Request):
+            self.requests.append(request)
+            if 'timeout' in request.url.path:
+                raise httpx.ConnectTimeout('timed out')
+            if 'pool' in request.url.path:
+                raise httpx.PoolTimeout('no free connection')
+            if 'error' in request.url.path:
+                raise ValueError('unexpected')
+            if request.headers.get('If-None-Match') == '"v1"':
+                return httpx.Response(304, headers={'ETag': '"v1"', 'Cache-Control': 'max-age=60'})
+            return httpx.Response(200, stream=httpx.ByteStream(b'image data'),
+                                  headers={'Content-Type': 'image/jpeg', 'ETag': '"v1"', 'Cache-Control': 'max-age=60'})
+
+        self.asgi_app = AsyncImageProxy(self.app, transport=httpx.MockTransport(handler))
+
+    def test_image_proxy(self):
+        status, headers, body = asgi_request(self.asgi_app, '/image/iiif/2/image-~path/full/full/0/default.jpg',
+                                             b'x=1', [('Host', 'localhost'), ('Accept', '*/*')])
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'image data')
+        self.assertEqual(headers['content-type'], 'image/jpeg')
+        self.assertEqual(headers['Access-Control-Allow-Origin'], '*')
+
+        request = self.requests[0]
+        self.assertEqual(str(request.url), 'http://localhost:8182/iiif/2/image-~path/full/full/0/default.jpg?x=1')
+        self.assertEqual(request.headers['X-Forwarded-Path'], '/v1/scan/image')
+        self.assertNotEqual(request.headers['Host'], 'localhost')
+
+        status, _, body = asgi_request(self.asgi_app, '/image/iiif/2/timeout/full/full/0/default.jpg')
+        self.assertEqual(status, 504)
+        self.assertEqual(json.loads(body), {'Message': 'Image server timed out'})
+
+    def test_image_proxy_releases_backend(self):
+        backend = image_api_client.backends.backends[0]
+
+        status, _, _ = asgi_request(self.asgi_app, '/image/iiif/2/pool/full/full/0/default.jpg')
+        self.assertEqual(status, 504)
+        self.assertEqual(backend.outstanding, 0)
+        self.assertEqual(backend.failures, 0)
+
+        with self.assertRaises(ValueError):
+            asgi_request(self.asgi_app, '/image/iiif/2/error/full/full/0/default.jpg')
+        self.assertEqual(backend.outstanding, 0)
+
+    def test_image_proxy_forwarded_headers(self):
+        status, _, _ = asgi_request(self.asgi_app, '/image/iiif/2/image-~path/full/full/0/default.jpg', b'',
+                                    [('X-Forwarded-Host', 'evil.example.com'), ('x-forwarded-path', '/evil')])
+        self.assertEqual(status, 200)
+
+        request = self.requests[0]
+        self.assertEqual(request.headers.get_list('X-Forwarded-Host'), [self.app.config['PROXY_SERVER']])
+        self.assertEqual(request.headers.get_list('X-Forwarded-Path'), ['/v1/scan/image'])
+
+    def test_image_proxy_coalesced(self):
+        cache_control = []
+
+        async def slow_handler(request: httpx.Request):
+            self.requests.append(request)
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, stream=httpx.ByteStream(b'image data'),
+                                  headers={'Content-Type': 'image/jpeg', 'Cache-Control': cache_control[0]})
+
+        async def concurrent_requests():
+            path = '/image/iiif/2/image-~path/full/full/0/default.jpg'
+            return await asyncio.gather(*[asgi_call(self.asgi_app, path) for _ in range(3)])
+
+        self.asgi_app = AsyncImageProxy(self.app, transport=httpx.MockTransport(slow_handler))
+        cache_control[:] = ['max-age=60']
+        responses = asyncio.run(concurrent_requests())
+        self.assertEqual([body for _, _, body in responses], [b'image data'] * 3)
+        self.assertEqual([headers.get('X-Cache') for _, headers, _ in responses].count('COALESCED'), 2)
+        self.assertEqual(len(self.requests), 1)
+
+        # Uncacheable responses are not shared, every request fetches its own
+        cache_control[:] = ['no-store']
+        responses = asyncio.run(concurrent_requests())
+        self.assertEqual([body for _, _, body in responses], [b'image data'] * 3)
+        self.assertEqual(len(self.requests), 4)
+
+    def test_image_proxy_cached(self):
+        path = '/image/iiif/2/image-~path/full/full/0/default.jpg'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['IMAGE_CACHE_DIR'] = cache_dir
+            image_cache.init_app(self.app)
+
+            threads = []
+            commit = image_cache.commit
+
+            def record_thread(*args):
+                threads.append(threading.current_thread())
+                commit(*args)
+
+            with patch.object(image_cache, 'commit', side_effect=record_thread):
+                status, headers, body = asgi_request(self.asgi_app, path)
+            self.assertEqual((status, headers['X-Cache'], body), (200, 'MISS', b'image data'))
+            # The store and its eviction scan don't block the event loop
+            self.assertNotEqual(threads, [threading.current_thread()])
+            self.assertEqual(len(threads), 1)
+
+            status, headers, body = asgi_request(self.asgi_app, path)
+            self.assertEqual((status, headers['X-Cache'], body), (200, 'HIT', b'image data'))
+            self.assertEqual(headers['Content-Length'], '10')
+            self.assertEqual(len(self.requests), 1)
+
+            status, headers, body = asgi_request(self.asgi_app, path, headers=[('If-None-Match', '"v1"')])
+            self.assertEqual((status, body), (304, b''))
+
+            self.app.config['IMAGE_CACHE_DIR'] = None
+            image_cache.init_app(self.app)
+
+    def test_thumbnail(self):
+        thumbnail_cache.set('article', 'bibcode', 'image-~path/square/480,480/0/default.jpg')
+        status, _, body = asgi_request(self.asgi_app, '/image/thumbnail', b'id=bibcode&type=article')
+        self.assertEqual((status, body), (200, b'image data'))
+        self.assertEqual(self.requests[0].url.path, '/iiif/2/image-~path/square/480,480/0/default.jpg')
+
+        self.app.config['THUMBNAIL_REDIRECT'] = True
+        status, headers, _ = asgi_request(self.asgi_app, '/image/thumbnail', b'id=bibcode&type=article')
+        self.assertEqual(status, 302)
+        self.assertEqual(headers['Location'],
+                         'http://localhost:8184/v1/scan/image/iiif/2/image-~path/square/480,480/0/default.jpg')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=3600')
+
+    def test_flask_fallback(self):
+        status, _, body = asgi_request(self.asgi_app, '/image/cache/stats')
+        self.assertEqual(status, 200)
+        self.assertFalse(json.loads(body)['enabled'])
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 from flask import url_for
+from sqlalchemy import event
 from unittest.mock import patch
 import unittest
 from scan_explorer_service.models import Collection, Page, Article
+from scan_explorer_service.extensions import search_cache, search_client
 from scan_explorer_service.tests.base import TestCaseDatabase
 from scan_explorer_service.models import Base
 import json
+import os
+import tempfile
 
 class TestManifest(TestCaseDatabase):
 
@@ -21,6 +25,8 @@ class TestManifest(TestCaseDatabase):
         })
 
     def setUp(self):
+        # Drop the pooled client, the next search creates one within the OpenSearch patch of the test
+        search_client.init_app(self.app)
         Base.metadata.drop_all(bind=self.app.db.engine)
         Base.metadata.create_all(bind=self.app.db.engine)
 
@@ -55,6 +61,240 @@ class TestManifest(TestCaseDatabase):
         self.assertStatus(r, 200)
         self.assertEqual(data['@type'], 'sc:Manifest')
 
+    def test_get_manifest_cached(self):
+        from scan_explorer_service.extensions import manifest_factory
+        url = url_for("manifest.get_manifest", id=self.article.id)
+
+        with patch.object(manifest_factory, 'create_manifest', wraps=manifest_factory.create_manifest) as create_manifest:
+            r1 = self.client.get(url)
+            r2 = self.client.get(url)
+
+        self.assertStatus(r2, 200)
+        self.assertEqual(create_manifest.call_count, 1)
+        self.assertEqual(r1.data, r2.data)
+
+    def test_manifest_cache_invalidated_on_put_page(self):
+        url = url_for("manifest.get_manifest", id=self.article.id)
+        page_json = {'name': 'page2', 'label': 'label2', 'width': 1000, 'height': 1000,
+                     'collection_id': self.collection.id, 'volume_running_page_num': 2,
+                     'articles': [{'bibcode': self.article.bibcode}]}
+
+        r = self.client.get(url)
+        self.assertEqual(len(json.loads(r.data)['sequences'][0]['canvases']), 1)
+
+        r = self.client.put(url_for("metadata.put_page"), json=page_json)
+        self.assertStatus(r, 200)
+
+        r = self.client.get(url)
+        self.assertEqual(len(json.loads(r.data)['sequences'][0]['canvases']), 2)
+
+        # Unlinking the page changes the article as well
+        del page_json['articles']
+        self.client.put(url_for("metadata.put_page"), json=page_json)
+        r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 200)
+        self.assertEqual(len(json.loads(r.data)['sequences'][0]['canvases']), 1)
+
+    def test_manifest_cache_invalidated_on_put_article(self):
+        other = Article(bibcode='1988ApJ...333..352S', collection_id=self.collection.id)
+        other.pages.append(self.page)
+        other.pages.append(Page(name='other', collection_id=self.collection.id, volume_running_page_num=1,
+                                width=1000, height=1000))
+        self.app.db.session.add(other)
+        self.app.db.session.commit()
+        article_json = {'bibcode': self.article.bibcode, 'collection_id': self.collection.id}
+        url = url_for("manifest.get_manifest", id=other.id)
+        r = self.client.get(url)
+        self.assertEqual(len(json.loads(r.data)['sequences'][0]['canvases']), 2)
+
+        # Replacing the article deletes its pages, which changes the other articles of those pages
+        self.assertStatus(self.client.put(url_for("metadata.put_article"), json=article_json), 200)
+        r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 200)
+        self.assertEqual(len(json.loads(r.data)['sequences'][0]['canvases']), 1)
+
+    def test_canvas_updated_on_put_page(self):
+        url = url_for("manifest.get_manifest", id=self.article.id)
+        canvas_url = url_for("manifest.get_canvas", page_id=self.page.id)
+        page_json = {'name': 'page', 'label': 'new', 'width': 2000, 'height': 1000,
+                     'collection_id': self.collection.id, 'volume_running_page_num': 0,
+                     'articles': [{'bibcode': self.article.bibcode}]}
+
+        canvas = json.loads(self.client.get(url).data)['sequences'][0]['canvases'][0]
+        self.assertEqual((canvas['label'], canvas['width']), ('p. label', 1000))
+        self.client.get(canvas_url)
+
+        r = self.client.put(url_for("metadata.put_page"), json=page_json)
+        self.assertStatus(r, 200)
+
+        canvas = json.loads(self.client.get(url).data)['sequences'][0]['canvases'][0]
+        self.assertEqual((canvas['label'], canvas['width']), ('p. new', 2000))
+        canvas = json.loads(self.client.get(canvas_url).data)
+        self.assertEqual((canvas['label'], canvas['width']), ('p. new', 2000))
+
+    def test_get_manifest_streaming(self):
+        from scan_explorer_service.extensions import manifest_cache
+        self.add_volume('streamed', 20)
+        url = url_for("manifest.get_manifest", id='journalstreamed')
+        expected = self.client.get(url).data
+        manifest_cache.memory.clear()
+
+        self.app.config['MANIFEST_STREAMING'] = True
+        r = self.client.get(url)
+
+        self.assertStatus(r, 200)
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(r.data, expected)
+        self.assertEqual(len(manifest_cache.memory), 1)
+
+        # Bodies over the limit are only written to disk, chunk by chunk
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config.update(MANIFEST_CACHE_DIR=cache_dir, MANIFEST_CACHE_STREAM_LIMIT=100)
+            manifest_cache.init_app(self.app)
+            r = self.client.get(url)
+            self.assertEqual(r.data, expected)
+            self.assertEqual(len(manifest_cache.memory), 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            self.app.config['MANIFEST_STREAMING'] = False
+            self.assertEqual(self.client.get(url).data, expected)
+            self.app.config.update(MANIFEST_CACHE_DIR=None, MANIFEST_CACHE_STREAM_LIMIT=16*1024*1024)
+            manifest_cache.init_app(self.app)
+
+    def test_get_manifest_fast_builder(self):
+        from scan_explorer_service.extensions import manifest_cache
+        collection_id = self.add_volume('fast', 10)
+        other_article = Article(bibcode='1988ApJ...fast..9S', collection_id=collection_id)
+        self.app.db.session.add(other_article)
+        for page in self.app.db.session.query(Page).filter(Page.collection_id == collection_id, Page.volume_running_page_num > 8):
+            other_article.pages.append(page)
+        self.app.db.session.commit()
+
+        for id in [collection_id, '1988ApJ...fast..9S', self.article.id]:
+            url = url_for("manifest.get_manifest", id=id)
+            manifest_cache.memory.clear()
+            self.app.config['MANIFEST_BUILDER'] = 'prezi'
+            expected = self.client.get(url).data
+
+            manifest_cache.memory.clear()
+            self.app.config['MANIFEST_BUILDER'] = 'fast'
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.data, expected)
+
+            manifest_cache.memory.clear()
+            self.app.config['MANIFEST_STREAMING'] = True
+            self.assertEqual(self.client.get(url).data, expected)
+            self.app.config['MANIFEST_STREAMING'] = False
+
+    def add_volume(self, volume: str, n_pages: int):
+        collection = Collection(type='type', journal='journal', volume=volume)
+        article = Article(bibcode=f'1988ApJ...{volume}..1R', collection_id=collection.id)
+        self.app.db.session.add_all([collection, article])
+        for n in range(1, n_pages + 1):
+            page = Page(name=f'page{n}', collection_id=collection.id, volume_running_page_num=n)
+            page.width = 1000
+            page.height = 1000
+            page.label = str(n)
+            article.pages.append(page)
+        self.app.db.session.commit()
+        return collection.id
+
+    def count_manifest_queries(self, id: str):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.app.db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            r = self.client.get(url_for("manifest.get_manifest", id=id))
+        finally:
+            event.remove(self.app.db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertStatus(r, 200)
+        return len(statements)
+
+    def test_get_manifest_query_count(self):
+        small_volume = self.add_volume('small', 2)
+        large_volume = self.add_volume('large', 50)
+
+        self.assertEqual(self.count_manifest_queries(small_volume), self.count_manifest_queries(large_volume))
+
+    def test_get_manifest_ranges(self):
+        collection = Collection(type='type', journal='journal', volume='ranges')
+        second = Article(bibcode='1988ApJ...777..3R', collection_id=collection.id)
+        first = Article(bibcode='1988ApJ...777..1R', collection_id=collection.id)
+        self.app.db.session.add_all([collection, second, first])
+        for n in range(1, 5):
+            page = Page(name=f'page{n}', collection_id=collection.id, volume_running_page_num=n)
+            page.width = 1000
+            page.height = 1000
+            page.label = str(n)
+            (first if n <= 2 else second).pages.append(page)
+        self.app.db.session.commit()
+        collection_id = collection.id
+
+        single_article_volume = self.add_volume('single', 4)
+        self.assertEqual(self.count_manifest_queries(collection_id), self.count_manifest_queries(single_article_volume))
+
+        data = json.loads(self.client.get(url_for("manifest.get_manifest", id=collection_id)).data)
+        canvases = [c['@id'] for c in data['sequences'][0]['canvases']]
+        self.assertEqual([r['label'] for r in data['structures']], ['1988ApJ...777..1R', '1988ApJ...777..3R'])
+        self.assertEqual(data['structures'][0]['canvases'], canvases[:2])
+        self.assertEqual(data['structures'][1]['canvases'], canvases[2:])
+
+    def test_get_manifest_collection(self):
+        volume = self.add_volume('paged', 5)
+        self.app.config['MANIFEST_CHUNK_SIZE'] = 2
+
+        r = self.client.get(url_for("manifest.get_manifest_collection", id=volume))
+        self.assertStatus(r, 200)
+        data = json.loads(r.data)
+        self.assertEqual(data['@type'], 'sc:Collection')
+        self.assertEqual([m['label'] for m in data['manifests']],
+                         [f'{volume} pages 1-2', f'{volume} pages 3-4', f'{volume} pages 5-5'])
+
+        r = self.client.get(data['manifests'][2]['@id'].replace('http://localhost:8184/v1/scan', ''))
+        self.assertStatus(r, 200)
+        chunk = json.loads(r.data)
+        self.assertEqual(chunk['@id'], data['manifests'][2]['@id'])
+        self.assertEqual([c['label'] for c in chunk['sequences'][0]['canvases']], ['p. 5'])
+        self.assertEqual(len(chunk['structures'][0]['canvases']), 1)
+
+        r = self.client.get(url_for("manifest.get_manifest_chunk", id=volume, chunk=3))
+        self.assertStatus(r, 404)
+
+        r = self.client.get(url_for("manifest.get_manifest_collection", id=volume, by='article'))
+        data = json.loads(r.data)
+        self.assertEqual([m['@id'] for m in data['manifests']],
+                         ['http://localhost:8184/v1/scan/manifest/1988ApJ...paged..1R/manifest.json'])
+
+        r = self.client.get(url_for("manifest.get_manifest_collection", id=volume, by='volume'))
+        self.assertStatus(r, 400)
+        self.app.config['MANIFEST_CHUNK_SIZE'] = 500
+
+    def test_get_manifest_not_modified(self):
+        url = url_for("manifest.get_manifest", id=self.article.id)
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        self.assertIsNotNone(r.headers.get('ETag'))
+        self.assertIsNotNone(r.headers.get('Last-Modified'))
+        self.assertIn('max-age', r.headers.get('Cache-Control'))
+
+        r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 304)
+        self.assertEqual(r.data, b'')
+
+        r = self.client.get(url, headers={'If-None-Match': '"outdated"'})
+        self.assertStatus(r, 200)
+
+    def test_get_canvas_not_modified(self):
+        url = url_for("manifest.get_canvas", page_id=self.page.id)
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+
+        r = self.client.get(url, headers={'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertStatus(r, 304)
+
     def test_get_canvas(self):
         url = url_for("manifest.get_canvas", page_id=self.page.id)
         r = self.client.get(url)
@@ -62,6 +302,49 @@ class TestManifest(TestCaseDatabase):
         self.assertStatus(r, 200)
         self.assertEqual(data['@type'], 'sc:Canvas')
 
+    def test_get_canvases(self):
+        volume = self.add_volume('batch', 5)
+
+        r = self.client.get(url_for("manifest.get_canvases", ids=f'{volume}_page3,{self.page.id},{volume}_page1'))
+        self.assertStatus(r, 200)
+        data = json.loads(r.data)
+        self.assertEqual([c['label'] for c in data['canvases']], ['p. 3', 'p. label', 'p. 1'])
+        single = json.loads(self.client.get(url_for("manifest.get_canvas", page_id=f'{volume}_page3')).data)
+        self.assertEqual(data['canvases'][0], single)
+
+        r = self.client.get(url_for("manifest.get_canvases", id=volume, page_start=2, page_end=4))
+        data = json.loads(r.data)
+        self.assertEqual([c['label'] for c in data['canvases']], ['p. 2', 'p. 3', 'p. 4'])
+
+        r = self.client.get(url_for("manifest.get_canvases", id=volume, page_start=2, page_end=4),
+                            headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 304)
+
+        self.app.config['CANVAS_BATCH_LIMIT'] = 2
+        r = self.client.get(url_for("manifest.get_canvases", id=volume, page_start=2))
+        self.assertEqual(len(json.loads(r.data)['canvases']), 2)
+        r = self.client.get(url_for("manifest.get_canvases", ids=f'{volume}_page1,{volume}_page2,{volume}_page3'))
+        self.assertStatus(r, 400)
+        self.app.config['CANVAS_BATCH_LIMIT'] = 1000
+
+        self.assertStatus(self.client.get(url_for("manifest.get_canvases")), 400)
+        self.assertStatus(self.client.get(url_for("manifest.get_canvases", ids='missing')), 404)
+
+    def test_canvas_cache(self):
+        from scan_explorer_service.extensions import manifest_factory
+        manifest_factory.set_canvas_cache(1)
+        other_volume = self.add_volume('other', 1)
+        url = url_for("manifest.get_canvas", page_id=self.page.id)
+
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(manifest_factory.canvas_cache_stats()['hits'], 1)
+
+        self.client.get(url_for("manifest.get_canvas", page_id=f'{other_volume}_page1'))
+        stats = manifest_factory.canvas_cache_stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
     @patch('opensearchpy.OpenSearch')
     def test_search_article_with_highlight(self, OpenSearch):
         open_search_highlight_response = {"hits":{"total":{"value":1,"relation":"eq"},"max_score":None,"hits":[{'_source':{'page_id':self.page.id, 'volume_id':self.page.collection_id, 'page_label':self.page.label, 'page_number': self.page.volume_running_page_num}, "highlight":{'text':'some <b>highlighted</b> text'}}]}}
@@ -78,6 +361,15 @@ class TestManifest(TestCaseDatabase):
         expected_query = {'query': {'bool': {'must': {'query_string': {'query': 'text article_bibcodes:' + article_id, 'default_field': 'text', 'default_operator': 'AND'}}}}, '_source': {'include': ['page_id', 'volume_id', 'page_label', 'page_number']}, 'highlight': {'fields': {'text': {}}, 'type': 'unified'}}
         self.assertEqual(expected_query, call_kwargs.get('body'))
 
+        self.assertNotIn('Last-Modified', r.headers)
+        r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 304)
+
+        # A flush of the search cache after a reindex changes the results
+        search_cache.flush()
+        r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+        self.assertStatus(r, 200)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,12 @@ from flask import url_for, jsonify
 import unittest
 from unittest.mock import patch
 from scan_explorer_service.models import Collection, Page, Article
+from scan_explorer_service.extensions import search_client
 from scan_explorer_service.tests.base import TestCaseDatabase
 from scan_explorer_service.models import Base
 import json
+import os
+import tempfile
 
 class TestMetadata(TestCaseDatabase):
 
@@ -23,6 +26,8 @@ class TestMetadata(TestCaseDatabase):
         })
 
     def setUp(self):
+        # Drop the pooled client, the next search creates one within the OpenSearch patch of the test
+        search_client.init_app(self.app)
         Base.metadata.drop_all(bind=self.app.db.engine)
         Base.metadata.create_all(bind=self.app.db.engine)
         self.collection = Collection(type = 'type', journal = 'journal', volume = 'volume')
@@ -82,18 +87,40 @@ class TestMetadata(TestCaseDatabase):
     @patch('opensearchpy.OpenSearch')
     def test_get_article(self, OpenSearch):
         es = OpenSearch.return_value
-        es.search.return_value = self.open_search_article_response
+        es.msearch.return_value = {'responses': [self.open_search_article_response, self.open_search_volume_response, self.open_search_page_response]}
 
         # Fetch     
         url = url_for("metadata.article_search", q='bibcode:' + self.article.bibcode, page=1, limit = 10)
         r = self.client.get(url)
-        expected_query = {'query': {'query_string': {'query': 'article_bibcodes_lowercase:1988ApJ...333..341R', 'fields': ['article_bibcodes', 'journal', 'volume_id_lowercase', 'volume'], 'default_operator': 'AND'}}, 'size': 0, 'aggs': {'total_count': {'cardinality': {'field': 'article_bibcodes'}}, 'ids': {'terms': {'field': 'article_bibcodes', 'size': 10000}, 'aggs': {'bucket_sort': {'bucket_sort': {'sort': [{'_key': {'order': 'desc'}}], 'size': 10, 'from': 0}}}}}}
-        call_args, call_kwargs = es.search.call_args
-        self.assertEqual(expected_query, call_kwargs.get('body'))
+        query_string_query = {'query_string': {'query': 'article_bibcodes_lowercase:1988ApJ...333..341R', 'fields': ['article_bibcodes', 'journal', 'volume_id_lowercase', 'volume'], 'default_operator': 'AND'}}
+        expected_query = {'query': query_string_query, 'size': 0, 'aggs': {'total_count': {'cardinality': {'field': 'article_bibcodes'}}, 'ids': {'terms': {'field': 'article_bibcodes', 'size': 10000}, 'aggs': {'bucket_sort': {'bucket_sort': {'sort': [{'_key': {'order': 'desc'}}], 'size': 10, 'from': 0}}}}}}
+        expected_collection_query = {'query': query_string_query, 'size': 0, 'aggs': {'total_count': {'cardinality': {'field': 'volume_id'}}}}
+        expected_page_query = {'query': query_string_query, 'size': 0, 'track_total_hits': True}
+        self.assertEqual(es.msearch.call_count, 1)
+        self.assertFalse(es.search.called)
+        call_args, call_kwargs = es.msearch.call_args
+        self.assertEqual([{}, expected_query, {}, expected_collection_query, {}, expected_page_query], call_kwargs.get('body'))
         self.assertStatus(r, 200)
         expected_response = {"extra_collection_count": 0, "extra_page_count": 0,  "items": [{"bibcode": self.article.bibcode, "id": self.article.id, "pages": 3 }], "limit": 10, "page": 1, "pageCount": 1, "query": "",  "total": 1}
         self.assertEqual(r.data, jsonify(expected_response).data)
 
+    @patch('opensearchpy.OpenSearch')
+    def test_search_client_pooled(self, OpenSearch):
+        es = OpenSearch.return_value
+        es.search.return_value = self.open_search_volume_response
+        collection_id = self.collection.id
+        self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, page=1, limit=10))
+        self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, page=2, limit=10))
+
+        self.assertEqual(OpenSearch.call_count, 1)
+        self.assertEqual(OpenSearch.call_args[0][0], ['http://localhost:1234'])
+        self.assertEqual(OpenSearch.call_args[1]['maxsize'], 10)
+
+        # A forked worker creates its own client
+        search_client._pid = -1
+        self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, page=3, limit=10))
+        self.assertEqual(OpenSearch.call_count, 2)
+
     @patch('opensearchpy.OpenSearch')
     def test_get_collection(self, OpenSearch):
         es = OpenSearch.return_value
@@ -110,6 +137,35 @@ class TestMetadata(TestCaseDatabase):
         expected_response = {"items": [{"id": self.collection.id ,"journal": "journ", "pages": 1, 'volume':'alvo' }], "limit": 10, "page": 1, "pageCount": 1, "query": "",  "total": 1}
         self.assertEqual(r.data, jsonify(expected_response).data)
 
+    @patch('opensearchpy.OpenSearch')
+    def test_get_collection_after(self, OpenSearch):
+        es = OpenSearch.return_value
+        collection_id = self.collection.id
+        es.search.return_value = {"hits":{"total":{"value":1,"relation":"eq"},"max_score":None,"hits":[]},"aggregations":{"total_count":{"value":2},"ids":{"after_key":{"id":collection_id},"buckets":[{"key":{"id":collection_id},"doc_count":1}]}}}
+
+        url = url_for("metadata.collection_search", q='bibstem:' + collection_id, limit=1, sort='collection_asc', after='')
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        call_args, call_kwargs = es.search.call_args
+        expected_aggs = {'total_count': {'cardinality': {'field': 'volume_id'}}, 'ids': {'composite': {'size': 1, 'sources': [{'id': {'terms': {'field': 'volume_id', 'order': 'asc'}}}]}}}
+        self.assertEqual(expected_aggs, call_kwargs.get('body')['aggs'])
+        self.assertEqual(r.json['items'][0]['id'], collection_id)
+        self.assertEqual(r.json['total'], 2)
+        after = r.json['after']
+
+        # The token continues after the last collection of the previous page
+        es.search.return_value = {"hits":{"total":{"value":1,"relation":"eq"},"max_score":None,"hits":[]},"aggregations":{"total_count":{"value":2},"ids":{"buckets":[]}}}
+        r = self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, limit=1, sort='collection_asc', after=after))
+        self.assertStatus(r, 200)
+        call_args, call_kwargs = es.search.call_args
+        self.assertEqual(call_kwargs.get('body')['aggs']['ids']['composite']['after'], {'id': collection_id})
+        self.assertIsNone(r.json['after'])
+
+        r = self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, after='invalid'))
+        self.assertStatus(r, 400)
+        r = self.client.get(url_for("metadata.collection_search", q='bibstem:' + collection_id, sort='relevance_desc', after=''))
+        self.assertStatus(r, 400)
+
     @patch('opensearchpy.OpenSearch')
     def test_get_page(self, OpenSearch):
         es = OpenSearch.return_value
@@ -126,6 +182,76 @@ class TestMetadata(TestCaseDatabase):
 
         self.assertEqual(str(r.data), str(jsonify(expected_response).data))
 
+    @patch('opensearchpy.OpenSearch')
+    def test_search_cache(self, OpenSearch):
+        es = OpenSearch.return_value
+        es.search.return_value = self.open_search_page_response
+
+        url = url_for("metadata.page_search", q='full:' + '"test text"', page=1, limit=10)
+        r = self.client.get(url)
+        self.assertEqual(r.headers['X-Cache'], 'MISS')
+
+        # Spacing of the query doesn't matter
+        cached = self.client.get(url_for("metadata.page_search", q='full:  "test text" ', page=1, limit=10))
+        self.assertEqual(cached.headers['X-Cache'], 'HIT')
+        self.assertEqual(cached.data, r.data)
+        self.assertEqual(es.search.call_count, 1)
+
+        self.client.get(url_for("metadata.page_search", q='full:' + '"test text"', page=2, limit=10))
+        self.assertEqual(es.search.call_count, 2)
+
+        r = self.client.delete(url_for("metadata.flush_search_cache"))
+        self.assertStatus(r, 200)
+        r = self.client.get(url)
+        self.assertEqual(r.headers['X-Cache'], 'MISS')
+        self.assertEqual(es.search.call_count, 3)
+
+    def test_search_cache_key(self):
+        from scan_explorer_service.search_cache import SearchCache
+        from scan_explorer_service.utils.search_utils import OrderOptions
+
+        def key(qs):
+            return SearchCache.key('metadata.page_search', qs, 1, 10, OrderOptions.Bibcode_desc)
+
+        self.assertEqual(key(' text:test   bibcode:"1988ApJ"  '), key('text:test bibcode:"1988ApJ"'))
+        # Whitespace within quoted phrases is significant
+        self.assertEqual(key('text:"a  b"   c'), key('text:"a  b" c'))
+        self.assertNotEqual(key('text:"a  b"'), key('text:"a b"'))
+
+    def test_search_cache_shared(self):
+        from scan_explorer_service.search_cache import SearchCache
+        from scan_explorer_service.utils.search_utils import OrderOptions
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['SEARCH_CACHE_DIR'] = cache_dir
+            worker1, worker2 = SearchCache(), SearchCache()
+            worker1.init_app(self.app)
+            worker2.init_app(self.app)
+
+            key = SearchCache.key('metadata.page_search', 'text:test', 1, 10, OrderOptions.Bibcode_desc)
+            worker1.set(key, b'{}')
+            self.assertEqual(worker2.get(key), b'{}')
+
+            # A flush of one worker drops the entries the other keeps in memory
+            worker1.flush()
+            self.assertIsNone(worker2.get(key))
+            self.assertEqual(os.listdir(cache_dir), ['flushed'])
+
+            # Expired entries are removed when they are read
+            worker2.ttl = -1
+            worker2.set(key, b'{}')
+            self.assertIsNone(worker1.get(key))
+            self.assertEqual(os.listdir(cache_dir), ['flushed'])
+
+            # The least recently used entries are removed over the size limit
+            self.app.config['SEARCH_CACHE_DIR_SIZE_LIMIT'] = 2000
+            worker1.init_app(self.app)
+            for page in range(40):
+                worker1.set(SearchCache.key('metadata.page_search', 'text:test', page, 10, OrderOptions.Bibcode_desc), b' ' * 100)
+            self.assertLessEqual(sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)), 2000)
+            self.assertIsNotNone(worker1.disk.get(SearchCache.key('metadata.page_search', 'text:test', 39, 10, OrderOptions.Bibcode_desc)))
+            self.app.config['SEARCH_CACHE_DIR'] = None
+
     def test_query_parsing_failures(self):
         url = url_for("metadata.article_search", q='')
         r = self.client.get(url)
@@ -146,10 +272,13 @@ class TestMetadata(TestCaseDatabase):
     @patch('opensearchpy.OpenSearch')
     def test_query_parsing_sucess(self, OpenSearch):
         es = OpenSearch.return_value
-        es.search.return_value = self.open_search_article_nohit_response
+        es.msearch.return_value = {'responses': [self.open_search_article_nohit_response, self.open_search_volume_response, self.open_search_page_response]}
         url = url_for("metadata.article_search", q='bibcode:1 bibstem:2 full:3 page_sequence:4 page:5 pagetype:Normal pagecolor:BW project:"PHaEDRA" volume:6')
         r = self.client.get(url)
         self.assertStatus(r, 200)
+        # The counts of the same round trip are returned instead
+        self.assertEqual(es.msearch.call_count, 1)
+        self.assertEqual((r.json['extra_collection_count'], r.json['extra_page_count']), (1, 1))
 
         url = url_for('metadata.article_search', q='pagetype:normal pagecolor:bw project:"historical literature"')
         r = self.client.get(url)
@@ -0,0 +1,59 @@
+import unittest
+import zlib
+from io import BytesIO
+from PIL import Image
+from scan_explorer_service.utils.pdf_utils import image_xobject, stream_pdf
+
+
+def image_bytes(mode: str, format: str, **kwargs) -> bytes:
+    image = BytesIO()
+    Image.new(mode, (200, 300)).save(image, format=format, **kwargs)
+    return image.getvalue()
+
+
+class TestPdfUtils(unittest.TestCase):
+
+    def test_stream_pdf(self):
+        images = [image_bytes('L', 'JPEG'), image_bytes('1', 'TIFF'), image_bytes('RGB', 'PNG')]
+        chunks = list(stream_pdf(images))
+        self.assertEqual(len(chunks), len(images) + 2)
+
+        pdf = b''.join(chunks)
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        self.assertIn(b'/Type /Pages /Kids [5 0 R 8 0 R 11 0 R] /Count 3', pdf)
+
+        # Every object of the cross reference table is at its recorded offset
+        startxref = int(pdf.rsplit(b'startxref\n', 1)[1].split(b'\n')[0])
+        lines = pdf[startxref:].split(b'\n')
+        self.assertEqual(lines[0], b'xref')
+        n_objects = int(lines[1].split()[1])
+        self.assertEqual(n_objects, 12)
+        for id in range(1, n_objects):
+            offset = int(lines[2 + id][:10])
+            self.assertTrue(pdf[offset:].startswith(f'{id} 0 obj\n'.encode()))
+
+    def test_image_xobject(self):
+        jpeg = image_bytes('RGB', 'JPEG', dpi=(300, 300))
+        entries, data, width, height = image_xobject(jpeg)
+        self.assertIn(b'/DCTDecode', entries)
+        self.assertIn(b'/DeviceRGB', entries)
+        self.assertEqual(data, jpeg)
+        self.assertEqual((width, height), (48, 72))
+
+        # Group 4 data is embedded as it is
+        tiff = image_bytes('1', 'TIFF', compression='group4')
+        entries, data, width, height = image_xobject(tiff)
+        self.assertIn(b'/BitsPerComponent 1', entries)
+        self.assertIn(b'/Filter /CCITTFaxDecode /DecodeParms << /K -1 /Columns 200 /Rows 300 /BlackIs1 true >>', entries)
+        self.assertIn(data, tiff)
+        self.assertLess(len(data), len(tiff))
+        self.assertEqual((width, height), (150, 225))
+
+        entries, data, width, height = image_xobject(image_bytes('1', 'TIFF'))
+        self.assertIn(b'/BitsPerComponent 1', entries)
+        self.assertIn(b'/FlateDecode', entries)
+        self.assertEqual(len(zlib.decompress(data)), 25 * 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,11 @@
+import math
+import os
+import tempfile
+import time
+from io import BytesIO
+import PIL.Image
 import unittest
+import requests
 from flask_testing import TestCase
 from flask import url_for
 from unittest.mock import patch
@@ -78,13 +85,16 @@ class TestProxy(TestCaseDatabase):
             def json(self):
                 return self.json_data
 
+            def close(self):
+                pass
+
         if 'notfound' in args[1]:
             return MockResponse({}, 401, {})
         elif 'badrequest' in args[1]:
             return MockResponse({}, 400, {})
         return MockResponse({}, 200, {})
 
-    @patch('requests.request', side_effect=mocked_request)
+    @patch('requests.Session.request', side_effect=mocked_request)
     def test_get_image(self, mock_request):
 
         url = url_for('proxy.image_proxy', path='valid-~image-~path')
@@ -101,7 +111,338 @@ class TestProxy(TestCaseDatabase):
         response = image_proxy('badrequest-~image-~path')
         assert(response.status_code == 400)
 
-    @patch('requests.request', side_effect=mocked_request)
+    @patch('requests.Session.request', side_effect=mocked_request)
+    def test_get_image_pooled(self, mock_request):
+        from scan_explorer_service.extensions import image_api_client
+
+        session = image_api_client.session
+        self.client.get(url_for('proxy.image_proxy', path='valid-~image-~path'))
+        self.client.get(url_for('proxy.image_proxy', path='valid-~image-~path'))
+
+        self.assertIs(image_api_client.session, session)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(mock_request.call_args[1]['timeout'], image_api_client.timeout)
+
+    @patch('requests.Session.request', side_effect=requests.exceptions.ConnectTimeout)
+    def test_get_image_timeout(self, mock_request):
+        response = self.client.get(url_for('proxy.image_proxy', path='valid-~image-~path'))
+        self.assertEqual(response.status_code, 504)
+
+    def test_get_image_cached(self):
+        from scan_explorer_service.extensions import image_cache
+
+        class Raw:
+            def stream(self, decode_content: bool):
+                return [b'image ', b'data']
+
+        class MockResponse:
+            def __init__(self, status_code, headers):
+                self.raw = Raw()
+                self.status_code = status_code
+                self.headers = headers
+
+            def close(self):
+                pass
+
+        url = url_for('proxy.image_proxy', path='image-~path/full/full/0/default.jpg')
+        with tempfile.TemporaryDirectory() as cache_dir, patch('requests.Session.request') as mock_request:
+            self.app.config['IMAGE_CACHE_DIR'] = cache_dir
+            image_cache.init_app(self.app)
+
+            mock_request.return_value = MockResponse(200, {'ETag': '"v1"', 'Cache-Control': 'max-age=60'})
+            response = self.client.get(url)
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(response.data, b'image data')
+
+            response = self.client.get(url)
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertEqual(response.data, b'image data')
+            self.assertEqual(mock_request.call_count, 1)
+
+            response = self.client.get(url, headers={'If-None-Match': '"v1"'})
+            self.assertEqual(response.status_code, 304)
+
+            other_url = url_for('proxy.image_proxy', path='image-~path/full/full/0/gray.jpg')
+            mock_request.return_value = MockResponse(200, {'ETag': '"v2"', 'Cache-Control': 'no-cache'})
+            self.assertEqual(self.client.get(other_url).data, b'image data')
+            mock_request.return_value = MockResponse(304, {'ETag': '"v2"', 'Cache-Control': 'no-cache'})
+            response = self.client.get(other_url)
+            self.assertEqual(response.headers['X-Cache'], 'REVALIDATED')
+            self.assertEqual(response.data, b'image data')
+            self.assertEqual(mock_request.call_args[1]['headers']['If-None-Match'], '"v2"')
+
+            mock_request.return_value = MockResponse(200, {'Cache-Control': 'no-store'})
+            self.client.get(url_for('proxy.image_proxy', path='uncached'))
+            self.assertEqual(self.client.get(url_for('proxy.image_proxy', path='uncached')).headers['X-Cache'], 'MISS')
+
+            stats = self.client.get(url_for('proxy.image_cache_stats')).json
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['revalidations'], 1)
+            self.assertEqual(stats['misses'], 4)
+            self.assertEqual(stats['hit_ratio'], 3 / 7)
+
+            self.app.config['IMAGE_CACHE_DIR'] = None
+            image_cache.init_app(self.app)
+
+    def test_image_requests_coalesced(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from scan_explorer_service.extensions import image_cache
+        from scan_explorer_service.views.image_proxy import fetch_image
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.2)
+            response = requests.Response()
+            response.status_code = 200
+            return response
+
+        with tempfile.TemporaryDirectory() as cache_dir, patch('requests.Session.request', side_effect=slow_request) as mock_request:
+            self.app.config['IMAGE_CACHE_DIR'] = cache_dir
+            image_cache.init_app(self.app)
+            with patch('requests.Response.content', b'image data'), patch('requests.Response.raise_for_status'):
+                with ThreadPoolExecutor(5) as executor:
+                    images = list(executor.map(lambda _: fetch_image({}, 'image-~path'), range(5)))
+
+            self.assertEqual(images, [b'image data'] * 5)
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(image_cache.stats()['coalesced'], 4)
+            self.assertFalse(os.path.exists(image_cache.locks.path(image_cache.key('image-~path', {}))))
+
+            # A fetch in flight in another worker holds the lock file
+            key = image_cache.key('other', {})
+            open(image_cache.locks.path(key), 'w').close()
+            self.assertFalse(image_cache.acquire(key))
+            os.utime(image_cache.locks.path(key), (0, 0))
+            self.assertTrue(image_cache.acquire(key))
+            image_cache.release(key)
+            self.assertFalse(os.path.exists(image_cache.locks.path(key)))
+
+            self.app.config['IMAGE_CACHE_DIR'] = None
+            image_cache.init_app(self.app)
+
+    def test_image_requests_coalesced_in_memory(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from scan_explorer_service.extensions import image_cache
+        from scan_explorer_service.views.image_proxy import fetch_image
+
+        cache_control = []
+
+        def slow_request(*args, **kwargs):
+            time.sleep(0.2)
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['Cache-Control'] = cache_control[0]
+            return response
+
+        # Without a cache directory the body is shared in memory
+        self.assertFalse(image_cache.enabled)
+        with patch('requests.Session.request', side_effect=slow_request) as mock_request:
+            with patch('requests.Response.content', b'image data'), patch('requests.Response.raise_for_status'):
+                cache_control[:] = ['max-age=60']
+                with ThreadPoolExecutor(5) as executor:
+                    images = list(executor.map(lambda _: fetch_image({}, 'image-~path'), range(5)))
+                self.assertEqual(images, [b'image data'] * 5)
+                self.assertEqual(mock_request.call_count, 1)
+                self.assertEqual(image_cache.stats()['coalesced'], 4)
+
+                # Uncacheable responses are not shared, every request fetches its own
+                cache_control[:] = ['no-store']
+                with ThreadPoolExecutor(5) as executor:
+                    images = list(executor.map(lambda _: fetch_image({}, 'image-~path'), range(5)))
+                self.assertEqual(images, [b'image data'] * 5)
+                self.assertEqual(mock_request.call_count, 6)
+
+    def test_image_cache_eviction(self):
+        from scan_explorer_service.image_cache import ImageCache
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['IMAGE_CACHE_DIR'] = cache_dir
+            self.app.config['IMAGE_CACHE_SIZE_LIMIT'] = 100
+            cache = ImageCache()
+            cache.init_app(self.app)
+            for n in range(4):
+                list(cache.store(f'image{n}', 200, [], None, 60, [b'x' * 40]))
+                # Distinct modification times, image1 is used after image2
+                os.utime(cache.bodies.path(f'image{n}'), (n, n if n != 1 else 10))
+
+            cache.evict(100)
+            self.assertIsNone(cache.get('image0'))
+            self.assertIsNone(cache.get('image2'))
+            self.assertIsNotNone(cache.get('image1'))
+            self.assertEqual(cache.stats()['evictions'], 2)
+            self.app.config['IMAGE_CACHE_DIR'] = None
+            self.app.config['IMAGE_CACHE_SIZE_LIMIT'] = 1024*1024*1024
+
+    def test_fetch_images_ordered(self):
+        from scan_explorer_service.views import image_proxy as image_proxy_module
+
+        def fetch_image(headers, path):
+            # Later pages finish first
+            time.sleep(0.01 * (5 - int(path)))
+            return path.encode() * 100
+
+        paths = [str(n) for n in range(5)]
+        with patch.object(image_proxy_module, 'fetch_image', side_effect=fetch_image) as mock_fetch:
+            images = list(image_proxy_module.fetch_images(paths, 3, 10**6))
+            self.assertEqual(images, [path.encode() * 100 for path in paths])
+
+            # Room for about one image, after the first requests only one image is requested ahead
+            mock_fetch.reset_mock()
+            for n, image in enumerate(image_proxy_module.fetch_images(paths, 3, 200), 1):
+                self.assertEqual(image, paths[n - 1].encode() * 100)
+                if n > 1:
+                    self.assertLessEqual(mock_fetch.call_count, max(3, n))
+            self.assertEqual(mock_fetch.call_count, 5)
+
+    @patch('requests.Session.request')
+    def test_pdf_save(self, mock_request):
+        image = BytesIO()
+        PIL.Image.new('L', (10, 10)).save(image, format='JPEG')
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = image.getvalue()
+        mock_request.return_value.headers = {}
+
+        response = self.client.get(url_for('proxy.pdf_save', id=self.collection.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/pdf')
+        self.assertTrue(response.is_streamed)
+        self.assertTrue(response.data.startswith(b'%PDF-1.4'))
+        self.assertIn(b'/Type /Pages /Kids [5 0 R] /Count 1', response.data)
+        self.assertTrue(response.data.endswith(b'%%EOF\n'))
+        self.assertTrue(mock_request.call_args[0][1].endswith('/full/full/0/default.tif'))
+
+    @patch('requests.Session.request')
+    def test_pdf_job(self, mock_request):
+        from scan_explorer_service.extensions import pdf_jobs
+
+        image = BytesIO()
+        PIL.Image.new('L', (10, 10)).save(image, format='JPEG')
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = image.getvalue()
+        mock_request.return_value.headers = {}
+
+        with tempfile.TemporaryDirectory() as job_dir:
+            self.app.config['PDF_JOB_DIR'] = job_dir
+            pdf_jobs.init_app(self.app)
+
+            url = url_for('proxy.pdf_save', id=self.collection.id, job='true')
+            response = self.client.get(url)
+            self.assertIn(response.status_code, [200, 202])
+            job_id = response.json['id']
+
+            # Identical requests share the job
+            self.assertEqual(self.client.get(url).json['id'], job_id)
+            self.assertNotEqual(pdf_jobs.job_id(self.collection.id, 1, math.inf, 300), job_id)
+
+            for _ in range(100):
+                status = self.client.get(url_for('proxy.pdf_job_status', job_id=job_id)).json
+                if status['status'] in ['done', 'failed']:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(status['status'], 'done')
+            self.assertIn('download_url', status)
+
+            response = self.client.get(url_for('proxy.pdf_job_download', job_id=job_id))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/pdf')
+            self.assertTrue(response.data.startswith(b'%PDF-1.4'))
+            response.close()
+
+            self.assertEqual(self.client.get(url_for('proxy.pdf_job_status', job_id='unknown')).status_code, 404)
+
+            pdf_jobs.ttl = -1
+            self.assertEqual(self.client.get(url_for('proxy.pdf_job_download', job_id=job_id)).status_code, 404)
+            self.app.config['PDF_JOB_DIR'] = None
+            pdf_jobs.init_app(self.app)
+
+    @patch('requests.Session.request', side_effect=mocked_request)
+    def test_get_image_info_local(self, mock_request):
+        with self.app.app_context():
+            image_path = self.app.db.session.query(Page).first().image_path
+
+        # Proxied unless enabled
+        self.client.get(url_for('proxy.image_proxy', path=f'{image_path}/info.json'))
+        self.assertTrue(mock_request.called)
+        mock_request.reset_mock()
+
+        self.app.config['IMAGE_INFO_LOCAL'] = True
+        response = self.client.get(url_for('proxy.image_proxy', path=f'{image_path}/info.json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Cache'], 'LOCAL')
+        self.assertFalse(mock_request.called)
+        info = response.json
+        self.assertEqual(info['@id'], f'http://localhost:8184/v1/scan/image/iiif/2/{image_path}')
+        self.assertEqual(info['profile'][0], 'http://iiif.io/api/image/2/level2.json')
+        self.assertEqual((info['width'], info['height']), (1000, 1000))
+        self.assertEqual(info['tiles'][0]['scaleFactors'], [1, 2])
+        self.assertEqual(info['sizes'], [{'width': 500, 'height': 500}, {'width': 1000, 'height': 1000}])
+
+        # Cached, and invalidated when the page is updated
+        with patch('scan_explorer_service.views.image_proxy.page_by_image_path') as mock_page:
+            self.client.get(url_for('proxy.image_proxy', path=f'{image_path}/info.json'))
+            self.assertFalse(mock_page.called)
+        page_json = {'name': 'page', 'collection_id': self.collection.id, 'volume_running_page_num': 100,
+                     'width': 2000, 'height': 1000}
+        self.client.put(url_for('metadata.put_page'), json=page_json)
+        info = self.client.get(url_for('proxy.image_proxy', path=f'{image_path}/info.json')).json
+        self.assertEqual(info['width'], 2000)
+
+        # Unknown images and pages without dimensions are answered by the image server
+        response = self.client.get(url_for('proxy.image_proxy', path='unknown-~image/info.json'))
+        self.assertTrue(mock_request.called)
+        self.assertNotIn('X-Cache', response.headers)
+
+    @patch('requests.Session.request')
+    def test_sprite(self, mock_request):
+        from scan_explorer_service.extensions import sprite_cache
+
+        image = BytesIO()
+        PIL.Image.new('L', (64, 100)).save(image, format='JPEG')
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.content = image.getvalue()
+        mock_request.return_value.headers = {}
+
+        collection_id, page_id = self.collection.id, self.page.id
+        with tempfile.TemporaryDirectory() as sprite_dir:
+            self.app.config['SPRITE_CACHE_DIR'] = sprite_dir
+            sprite_cache.init_app(self.app)
+
+            response = self.client.get(url_for('proxy.sprite_json', id=collection_id, page_start=1, page_end=200))
+            self.assertEqual(response.status_code, 200)
+            page = response.json['pages'][0]
+            self.assertEqual(page['id'], page_id)
+            self.assertEqual((page['x'], page['y'], page['width'], page['height']), (32, 14, 64, 100))
+            self.assertIn('/image/sprite/', response.json['sprite_url'])
+            self.assertTrue(mock_request.call_args[0][1].endswith('/full/!128,128/0/default.jpg'))
+
+            # The image is generated together with the offsets
+            response = self.client.get(url_for('proxy.sprite_image', id=collection_id, page_start=1, page_end=200))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/jpeg')
+            self.assertEqual(PIL.Image.open(BytesIO(response.data)).size, (128, 128))
+            response.close()
+            self.assertEqual(mock_request.call_count, 1)
+
+            # Shifted ranges are served from the sprite of their block of pages
+            response = self.client.get(url_for('proxy.sprite_json', id=collection_id, page_start=2, page_end=20))
+            self.assertEqual((response.json['page_start'], response.json['page_end']), (1, 500))
+            self.assertEqual(mock_request.call_count, 1)
+
+            # An evicted image is generated again
+            for name in os.listdir(sprite_dir):
+                if name.endswith('.jpg'):
+                    os.remove(os.path.join(sprite_dir, name))
+            response = self.client.get(url_for('proxy.sprite_image', id=collection_id, page_start=1))
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            self.assertEqual(mock_request.call_count, 2)
+
+            response = self.client.get(url_for('proxy.sprite_json', id=collection_id, page_start=501))
+            self.assertEqual(response.status_code, 400)
+
+            self.app.config['SPRITE_CACHE_DIR'] = None
+            sprite_cache.init_app(self.app)
+
+    @patch('requests.Session.request', side_effect=mocked_request)
     def test_get_thumbnail(self, mock_request):
 
         data = {
@@ -117,6 +458,39 @@ class TestProxy(TestCaseDatabase):
         assert(response.is_streamed)
         assert(response.status_code == 200)
 
+    @patch('requests.Session.request', side_effect=mocked_request)
+    def test_get_thumbnail_cached(self, mock_request):
+        from scan_explorer_service.extensions import thumbnail_cache
+
+        article_id, collection_id = self.article.id, self.collection.id
+        url = url_for('proxy.image_proxy_thumbnail', id=article_id, type='article')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        path = thumbnail_cache.get('article', article_id)
+        self.assertTrue(path.endswith('/square/480,480/0/default.jpg'))
+
+        # Later requests don't resolve the thumbnail again
+        with patch('scan_explorer_service.views.image_proxy.item_thumbnail') as mock_thumbnail:
+            self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertFalse(mock_thumbnail.called)
+
+        self.app.config['THUMBNAIL_REDIRECT'] = True
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(f'/image/iiif/2/{path}'))
+        self.assertIn('max-age=3600', response.headers['Cache-Control'])
+
+        self.app.config['THUMBNAIL_REDIRECT_BASE_URL'] = 'https://images.example.org/iiif/2/'
+        response = self.client.get(url)
+        self.assertEqual(response.location, f'https://images.example.org/iiif/2/{path}')
+
+        thumbnail_cache.invalidate(collection_id, article_id)
+        self.assertIsNone(thumbnail_cache.get('article', article_id))
+
+        # Entries expire after the ttl
+        thumbnail_cache.memory.ttl = -1
+        thumbnail_cache.set('article', article_id, path)
+        self.assertIsNone(thumbnail_cache.get('article', article_id))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 from scan_explorer_service.app import create_app
 from scan_explorer_service.tests.base import TestCaseDatabase
-from scan_explorer_service.utils.search_utils import parse_query_string
+from scan_explorer_service.utils.search_utils import decode_after_token, encode_after_token, parse_query_string
 
 
 class TestSearchUtils(TestCaseDatabase):
@@ -37,6 +37,16 @@ class TestSearchUtils(TestCaseDatabase):
         final_query, _ = parse_query_string('PageColor:grAYsCaLe')
         self.assertEqual(final_query, 'page_color:Grayscale')
 
+    def test_after_token(self):
+        after_key = {'id': '1988ApJ...333..341R'}
+        token = encode_after_token(after_key)
+        self.assertNotIn('=', token)
+        self.assertEqual(decode_after_token(token), after_key)
+
+        for invalid in ['invalid', encode_after_token(['list'])]:
+            with self.assertRaises(Exception):
+                decode_after_token(invalid)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from flask import Flask
+from scan_explorer_service.upstream_client import BackendPool, UpstreamClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = self.server.name.encode()
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_server(name: str, status: int = 200, delay: float = 0) -> ThreadingHTTPServer:
+    """ Local image server answering every request with its name """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.name, server.status, server.delay = name, status, delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def closed_port_url() -> str:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{s.getsockname()[1]}'
+
+
+class TestUpstreamClient(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def create_client(self, *servers: str, **config) -> UpstreamClient:
+        app = Flask(__name__)
+        app.config.update(TEST_SERVERS=list(servers), TEST_BASE_PATH='/iiif/2', TEST_RETRIES=0, **config)
+        client = UpstreamClient('TEST')
+        client.init_app(app)
+        return client
+
+    def start(self, *args, **kwargs) -> str:
+        server = stub_server(*args, **kwargs)
+        self.servers.append(server)
+        return server_url(server)
+
+    def test_least_outstanding(self):
+        pool = BackendPool(['http://a', 'http://b', 'http://c'])
+        first, second, third = pool.acquire(), pool.acquire(), pool.acquire()
+        self.assertEqual({first.url, second.url, third.url}, {'http://a', 'http://b', 'http://c'})
+
+        pool.release(second, True)
+        self.assertIs(pool.acquire(), second)
+        self.assertIsNone(pool.acquire(exclude=pool.backends))
+
+    def test_circuit_breaker(self):
+        pool = BackendPool(['http://a', 'http://b'], failure_threshold=2, reset_timeout=60)
+        a, b = pool.backends
+        for _ in range(2):
+            pool.release(pool.acquire(exclude=[b]), False)
+        self.assertGreater(a.open_until, time.time())
+        self.assertEqual([pool.acquire().url for _ in range(3)], ['http://b'] * 3)
+
+        # A trial request after the reset timeout closes the circuit again
+        a.open_until = time.time() - 1
+        trial = pool.acquire(exclude=[b])
+        self.assertTrue(trial.trial)
+        self.assertIs(pool.acquire(exclude=[b]), a)
+        pool.release(trial, True)
+        self.assertEqual((a.open_until, a.failures, a.trial), (0.0, 0, False))
+
+    def test_fail_over(self):
+        healthy = self.start('healthy')
+        client = self.create_client(closed_port_url(), healthy, TEST_CIRCUIT_FAILURES=1)
+        dead, busy = client.backends.backends
+        # The least busy server, so the dead one, gets the first request instead of a random pick
+        busy.outstanding += 1
+
+        responses = [client.request('GET', 'image/info.json') for _ in range(4)]
+        self.assertEqual([r.content for r in responses], [b'healthy'] * 4)
+        self.assertGreater(dead.open_until, time.time())
+        busy.outstanding -= 1
+        self.assertEqual(sum(backend.outstanding for backend in client.backends.backends), 0)
+
+        failing = self.create_client(self.start('failing', status=503), TEST_CIRCUIT_FAILURES=1)
+        r = failing.request('GET', 'image/info.json', stream=True)
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(failing.backends.backends[0].outstanding, 1)
+        r.close()
+        self.assertEqual(failing.backends.backends[0].outstanding, 0)
+        self.assertGreater(failing.backends.backends[0].open_until, 0)
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.create_client(closed_port_url()).request('GET', 'image/info.json')
+
+    def test_hedged_request(self):
+        client = self.create_client(self.start('slow', delay=1), self.start('fast'), TEST_HEDGE_DELAY=0.05)
+        for _ in range(2):
+            start = time.time()
+            r = client.request('GET', 'image/full/full/0/default.jpg')
+            self.assertEqual(r.content, b'fast')
+            self.assertLess(time.time() - start, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
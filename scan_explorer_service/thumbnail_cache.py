@@ -0,0 +1,35 @@
+from typing import Optional
+from flask import Flask
+from scan_explorer_service.utils.cache_utils import TTLCache
+
+THUMBNAIL_TYPES = ['page', 'article', 'collection']
+
+
+class ThumbnailCache:
+    """ In-process map of item ids to the image server path of their thumbnail.
+
+    Resolving a thumbnail of an article or collection means finding its first
+    page, the cached path saves that query for every repeated request. The
+    metadata updates invalidate the entries of the changed items, entries of
+    other workers expire after the ttl.
+    """
+
+    def __init__(self):
+        self.memory = TTLCache(0)
+
+    def init_app(self, app: Flask):
+        self.memory = TTLCache(app.config.get('THUMBNAIL_CACHE_SIZE', 0), app.config.get('THUMBNAIL_CACHE_TTL', 3600))
+
+    def get(self, type: str, id: str) -> Optional[str]:
+        return self.memory.get((type, id))
+
+    def set(self, type: str, id: str, path: str):
+        self.memory.set((type, id), path)
+
+    def invalidate(self, *ids: str):
+        for id in ids:
+            for type in THUMBNAIL_TYPES:
+                self.memory.pop((type, id))
+
+    def stats(self) -> dict:
+        return self.memory.stats()
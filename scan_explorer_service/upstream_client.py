@@ -0,0 +1,243 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterable, List, Optional
+from urllib import parse as urlparse
+import requests
+from flask import Flask
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Backend:
+    """ An upstream server with its requests in flight and circuit breaker state """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.failures = 0
+        # 0 while the circuit is closed
+        self.open_until = 0.0
+        self.trial = False
+
+    def __repr__(self):
+        return f'Backend({self.url!r})'
+
+
+class BackendPool:
+    """ Least outstanding requests balancing over upstream servers with passive health checks.
+
+    The outcome of every request is reported back through release. After
+    failure_threshold consecutive failures the circuit of a backend opens and
+    it gets no requests for reset_timeout seconds, then a single trial request
+    decides whether the circuit closes again. If the circuits of all backends
+    are open they are still used, the one which opens again first is chosen.
+    """
+
+    def __init__(self, urls: Iterable[str], failure_threshold: int = 5, reset_timeout: float = 30):
+        self.backends = [Backend(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude: Iterable[Backend] = ()) -> Optional[Backend]:
+        """ Backend for the next request, None if all backends are excluded """
+        now = time.time()
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                return None
+
+            available = [backend for backend in candidates if backend.open_until <= now and not backend.trial]
+            if available:
+                least = min(backend.outstanding for backend in available)
+                backend = random.choice([backend for backend in available if backend.outstanding == least])
+                backend.trial = backend.open_until > 0
+            else:
+                backend = min(candidates, key=lambda backend: backend.open_until)
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend: Backend, ok: bool):
+        """ Reports the end of a request to the backend, ok is False on errors of the backend """
+        with self._lock:
+            backend.outstanding -= 1
+            trial, backend.trial = backend.trial, False
+            if ok:
+                backend.failures = 0
+                backend.open_until = 0.0
+            else:
+                backend.failures += 1
+                if trial or backend.failures >= self.failure_threshold:
+                    backend.open_until = time.time() + self.reset_timeout
+
+
+class UpstreamClient:
+    """ Pooled keep-alive HTTP client for a group of upstream servers.
+
+    Connections are reused between requests through a requests session with a
+    bounded connection pool. Every worker process creates its own session, so
+    pooled sockets are never shared across a fork. Requests are balanced over
+    the servers by a BackendPool and fail over to another server on connection
+    errors. With a hedge delay, a GET request which got no response within the
+    delay is sent to a second server as well and the first response is used.
+    Servers, pool size, timeouts, retries, circuit breaker, hedging and the
+    number of threads for concurrent requests are read from the config
+    settings starting with the given prefix.
+    """
+
+    def __init__(self, config_prefix: str):
+        self.config_prefix = config_prefix
+        self.pool_size = 10
+        self.timeout = (3.05, 30)
+        self.retries = 2
+        self.max_concurrency = 8
+        self.hedge_delay: Optional[float] = None
+        self.backends = BackendPool([])
+        self._session: Optional[requests.Session] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+
+    def init_app(self, app: Flask):
+        prefix = self.config_prefix
+        self.pool_size = app.config.get(f'{prefix}_POOL_SIZE', self.pool_size)
+        self.timeout = (app.config.get(f'{prefix}_CONNECT_TIMEOUT', self.timeout[0]),
+                        app.config.get(f'{prefix}_READ_TIMEOUT', self.timeout[1]))
+        self.retries = app.config.get(f'{prefix}_RETRIES', self.retries)
+        self.max_concurrency = app.config.get(f'{prefix}_MAX_CONCURRENCY', self.max_concurrency)
+        self.hedge_delay = app.config.get(f'{prefix}_HEDGE_DELAY', self.hedge_delay)
+        servers = app.config.get(f'{prefix}_SERVERS') or [app.config.get(f'{prefix}_SERVER')]
+        base_path = app.config.get(f'{prefix}_BASE_PATH', '')
+        self.backends = BackendPool([f'{server.rstrip("/")}{base_path}' for server in servers],
+                                    app.config.get(f'{prefix}_CIRCUIT_FAILURES', 5),
+                                    app.config.get(f'{prefix}_CIRCUIT_RESET', 30))
+        self._session = None
+        self._executor = None
+        self._hedge_executor = None
+
+    @property
+    def session(self) -> requests.Session:
+        self._check_pid()
+        if self._session is None:
+            self._session = self.create_session()
+        return self._session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """ Thread pool shared by all concurrent upstream requests of the worker process """
+        self._check_pid()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=self.config_prefix)
+        return self._executor
+
+    @property
+    def hedge_executor(self) -> ThreadPoolExecutor:
+        # Separate from the executor, whose threads may be waiting on hedged requests
+        self._check_pid()
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=2 * self.pool_size,
+                                                      thread_name_prefix=f'{self.config_prefix}-hedge')
+        return self._hedge_executor
+
+    def _check_pid(self):
+        # Sessions and threads of the parent process are unusable after a fork
+        if self._pid != os.getpid():
+            self._session = None
+            self._executor = None
+            self._hedge_executor = None
+            self._pid = os.getpid()
+
+    def create_session(self) -> requests.Session:
+        # Only idempotent requests are retried, on connection errors and gateway errors of the upstream
+        retry = Retry(total=self.retries, backoff_factor=0.1, status_forcelist=[502, 503, 504],
+                      allowed_methods=['GET', 'HEAD'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """ Sends a request for a path relative to the base url of the servers.
+
+        Streamed responses must be closed, they count as in flight until then.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if method == 'GET' and self.hedge_delay is not None and len(self.backends.backends) > 1:
+            return self._hedged_request(path, **kwargs)
+
+        tried: List[Backend] = []
+        while True:
+            backend = self.backends.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                return self._send(backend, method, path, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if len(tried) == len(self.backends.backends):
+                    raise
+
+    def _send(self, backend: Backend, method: str, path: str, **kwargs) -> requests.Response:
+        url = urlparse.urljoin(f'{backend.url}/', path)
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.backends.release(backend, False)
+            raise
+
+        ok = r.status_code < 500
+        if not kwargs.get('stream'):
+            self.backends.release(backend, ok)
+            return r
+
+        released = []
+        close = r.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self.backends.release(backend, ok)
+
+        r.close = close_and_release
+        return r
+
+    def _hedged_request(self, path: str, **kwargs) -> requests.Response:
+        backend = self.backends.acquire()
+        tried = [backend]
+        futures = {self.hedge_executor.submit(self._send, backend, 'GET', path, **kwargs)}
+        hedged = False
+        response, error = None, None
+        while futures and response is None:
+            done, futures = wait(futures, timeout=None if hedged else self.hedge_delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception():
+                    error = future.exception()
+                elif response is None:
+                    response = future.result()
+                else:
+                    future.result().close()
+
+            if response is None and not hedged:
+                # The first server is slow or failed, try another one
+                hedged = True
+                backend = self.backends.acquire(exclude=tried)
+                if backend:
+                    tried.append(backend)
+                    futures.add(self.hedge_executor.submit(self._send, backend, 'GET', path, **kwargs))
+
+        for future in futures:
+            future.add_done_callback(close_response)
+        if response is None:
+            raise error
+        return response
+
+
+def close_response(future: Future):
+    """ Closes the response of a request which lost a hedged race """
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
@@ -0,0 +1,245 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+
+def approximate_size(obj, seen: Optional[set] = None) -> int:
+    """ Approximate the memory used by an object and everything it references.
+
+    Attributes starting with an underscore are skipped, they usually point to
+    shared objects such as the manifest factory.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approximate_size(k, seen) + approximate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(approximate_size(v, seen) for v in obj)
+    elif hasattr(obj, '__dict__'):
+        size += sum(approximate_size(v, seen) for k, v in vars(obj).items() if not k.startswith('_'))
+    return size
+
+
+class LRUCache:
+    """ Thread safe in-process cache with least recently used eviction.
+
+    Holds at most max_entries items, a max_entries of 0 disables the cache.
+    When max_bytes is set the total size of the values, as measured by sizeof,
+    is bounded as well.
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 0, sizeof: Callable = approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self.sizeof(value) if self.max_bytes else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.current_bytes += size
+            while self._data and (len(self._data) > self.max_entries or
+                                  (self.max_bytes and self.current_bytes > self.max_bytes)):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self.current_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _remove(self, key, default=None):
+        self.current_bytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """ LRUCache whose entries expire ttl seconds after they were set.
+
+    Suits in-process caches of values which other workers may change, the
+    ttl bounds how long a worker uses a value after it was changed elsewhere.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl: float = 3600, max_bytes: int = 0, sizeof: Callable = approximate_size):
+        super().__init__(max_entries, max_bytes, sizeof)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None or entry[1] <= time.time():
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        super().set(key, (value, time.time() + self.ttl))
+
+    def pop(self, key, default=None):
+        entry = super().pop(key)
+        return default if entry is None else entry[0]
+
+
+def atomic_write(path: str, data: bytes):
+    """ Writes through a temporary file in the same directory which is renamed in place,
+    readers never see a partially written file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp creates files only readable by the owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DiskStore:
+    """ Directory backed store of serialized values.
+
+    Keys are hashed to file names and every write goes through a temporary
+    file which is renamed in place, so several worker processes can share
+    the same directory. With max_bytes the modification time of a file is
+    its last use, when the files of the store grow over the limit the least
+    recently used are removed.
+    """
+
+    def __init__(self, directory: str, suffix: str = '', max_bytes: int = 0):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        # The first write of every worker checks the size of the directory
+        self._bytes_since_check = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    def get(self, key: str):
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.touch(key)
+        return data
+
+    def set(self, key: str, data: bytes):
+        atomic_write(self.path(key), data)
+        self.evict(len(data))
+
+    def temp_file(self) -> Tuple[int, str]:
+        """ Open file descriptor and path of a temporary file for a value written incrementally """
+        return tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+
+    def commit(self, key: str, tmp_path: str):
+        """ Moves a completely written temporary file in place """
+        size = os.path.getsize(tmp_path)
+        # mkstemp creates files only readable by the owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path(key))
+        self.evict(size)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def touch(self, key: str):
+        """ Marks an entry as used, for entries which are read through their path """
+        if self.max_bytes:
+            try:
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, written: int = 0):
+        """ Removes the least recently used files once the store exceeds max_bytes.
+
+        The directory is only scanned after every 5% of the limit written by this worker.
+        """
+        if not self.max_bytes:
+            return
+        with self._lock:
+            self._bytes_since_check += written
+            if self._bytes_since_check < self.max_bytes // 20:
+                return
+            self._bytes_since_check = 0
+
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix) and not entry.name.startswith('.tmp-'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        # Evict below the limit so the next writes don't immediately trigger another scan
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
@@ -1,5 +1,11 @@
-from sqlalchemy import or_
-from scan_explorer_service.models import Article, Collection, Page
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Optional, Union
+from flask import current_app
+from sqlalchemy import func, or_
+from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from scan_explorer_service.models import Article, Collection, Page, page_article_association_table
 
 
 def collection_exists(session, journal, volume):
@@ -67,14 +73,143 @@ def collection_overwrite(session, collection):
     overwrite(session, collection, persisted)
 
 
-def article_overwrite(session, article):
+def article_overwrite(session, article) -> List[str]:
+    """ Replaces the persisted article, returns the ids of the other articles of the pages deleted with it """
     persisted = article_get(session, article.bibcode)
+    other_article_ids = []
+    if persisted:
+        page_ids = session.query(page_article_association_table.c.page_id).filter(
+            page_article_association_table.c.article_id == persisted.id)
+        other_article_ids = [article_id for article_id, in session.query(page_article_association_table.c.article_id).filter(
+            page_article_association_table.c.page_id.in_(page_ids.scalar_subquery()),
+            page_article_association_table.c.article_id != persisted.id).distinct()]
     overwrite(session, article, persisted)
+    return other_article_ids
 
 
-def page_overwrite(session, page):
+def page_overwrite(session, page) -> List[str]:
+    """ Replaces the persisted page, returns the ids of the articles the replaced page belonged to """
     persisted = page_get(session, page.collection_id, page.name, page.volume_running_page_num)
+    previous_article_ids = [article.id for article in persisted.articles] if persisted else []
     overwrite(session, page, persisted)
+    return previous_article_ids
+
+def item_manifest_rows(session, item: Union[Article, Collection], offset: int = 0, limit: Optional[int] = None):
+    """ Loads plain row tuples for the fast manifest builder.
+
+    Returns the pages in page order joined with their collection and the
+    (page_id, article_id, bibcode) links of those pages, also in page order.
+    Offset and limit select a slice of the pages in page order.
+    """
+    page_ids = item_page_ids(session, item, offset, limit)
+    pages = session.query(Page.id, Page.name, Page.label, Page.format, Page.color_type, Page.width, Page.height,
+                          Collection.type, Collection.journal, Collection.volume).join(
+        Collection, Collection.id == Page.collection_id).filter(
+        Page.id.in_(page_ids.scalar_subquery())).order_by(Page.volume_running_page_num).all()
+
+    links = item_page_links(session, page_ids, Article.id, Article.bibcode).all()
+    return pages, links
+
+
+def collection_touch(session, collection_id):
+    session.query(Collection).filter(Collection.id == collection_id).update(
+        {Collection.updated: datetime.utcnow()}, synchronize_session=False)
+
+
+def articles_touch(session, article_ids):
+    if article_ids:
+        session.query(Article).filter(Article.id.in_(article_ids)).update(
+            {Article.updated: datetime.utcnow()}, synchronize_session=False)
+
+def item_page_ids(session, item: Union[Article, Collection], offset: int = 0, limit: Optional[int] = None):
+    if isinstance(item, Article):
+        query = session.query(page_article_association_table.c.page_id).join(
+            Page, Page.id == page_article_association_table.c.page_id).filter(
+            page_article_association_table.c.article_id == item.id)
+    else:
+        query = session.query(Page.id).filter(Page.collection_id == item.id)
+
+    if offset or limit is not None:
+        query = query.order_by(Page.volume_running_page_num).offset(offset).limit(limit)
+    return query
+
+
+def item_page_count(session, item: Union[Article, Collection]) -> int:
+    return item_page_ids(session, item).count()
+
+
+def collection_articles(session, collection_id):
+    """ (article_id, bibcode) of the articles with pages in a collection, ordered by their first page """
+    return session.query(Article.id, Article.bibcode).join(
+        page_article_association_table, page_article_association_table.c.article_id == Article.id).join(
+        Page, Page.id == page_article_association_table.c.page_id).filter(
+        Page.collection_id == collection_id).group_by(Article.id, Article.bibcode).order_by(
+        func.min(Page.volume_running_page_num), Article.id).all()
+
+
+def item_page_links(session, page_ids, *columns):
+    """ Query over page2article joined to page for the given page ids, in page order.
+
+    Returns (page_id, *columns) rows with the article columns of every page, the
+    articles of a page ordered by id.
+    """
+    return session.query(page_article_association_table.c.page_id, *columns).join(
+        Page, Page.id == page_article_association_table.c.page_id).join(
+        Article, Article.id == page_article_association_table.c.article_id).filter(
+        page_article_association_table.c.page_id.in_(page_ids.scalar_subquery())).order_by(
+        Page.volume_running_page_num, Article.id)
+
+
+def item_manifest_pages(session, item: Union[Article, Collection], offset: int = 0, limit: Optional[int] = None) -> List[Page]:
+    """ Loads all pages of an item in page order for manifest creation.
+
+    The pages are returned with their collection and articles already loaded,
+    using the same two queries regardless of the number of pages. Offset and
+    limit select a slice of the pages in page order.
+    """
+    return manifest_pages(session, item_page_ids(session, item, offset, limit))
+
+
+def canvas_pages(session, page_ids: Optional[List[str]] = None, collection_id: Optional[str] = None,
+                 page_start: int = 1, page_end: Optional[int] = None) -> List[Page]:
+    """ Loads pages by id, or by running page number range within a collection, for canvas creation """
+    if page_ids is not None:
+        query = session.query(Page.id).filter(Page.id.in_(page_ids))
+    else:
+        query = session.query(Page.id).filter(Page.collection_id == collection_id).filter(
+            Page.volume_running_page_num >= page_start)
+        if page_end is not None:
+            query = query.filter(Page.volume_running_page_num <= page_end)
+    return manifest_pages(session, query)
+
+
+def manifest_pages(session, page_ids) -> List[Page]:
+    """ Loads the pages of a page id query in page order, with their collection and articles already loaded """
+    pages = session.query(Page).options(joinedload(Page.collection)).filter(
+        Page.id.in_(page_ids.scalar_subquery())).order_by(Page.volume_running_page_num).all()
+
+    links = item_page_links(session, page_ids, Article)
+
+    page_articles = defaultdict(list)
+    for page_id, article in links:
+        page_articles[page_id].append(article)
+
+    for page in pages:
+        set_committed_value(page, 'articles', page_articles[page.id])
+    return pages
+
+def page_by_image_path(session, image_path: str) -> Optional[Page]:
+    """ The page with the given image server identifier, see Page.image_path """
+    separator = current_app.config.get('IMAGE_API_SLASH_SUB', '%2F')
+    parts = image_path.split(separator)
+    if len(parts) < 6 or parts[0] != 'bitmaps':
+        return None
+    name = separator.join(parts[5:])
+    names = [name, name[:-len('.tif')]] if name.endswith('.tif') else [name]
+
+    pages = session.query(Page).join(Collection, Page.collection).options(contains_eager(Page.collection)).filter(
+        Page.name.in_(names), func.replace(Collection.volume, '.', '_') == parts[3]).all()
+    return next((page for page in pages if page.image_path == image_path), None)
 
 def article_thumbnail(session, id):
     page = session.query(Page).join(Article, Page.articles).filter(
@@ -0,0 +1,52 @@
+from typing import Callable, Iterator, Sequence
+from flask import current_app
+
+
+class LazyList(list):
+    """ List whose elements are only created while it is being iterated.
+
+    Used to hand large structures to the json encoder without building them
+    in memory first. Each item is converted with to_json when reached.
+    """
+
+    def __init__(self, items: Sequence, to_json: Callable):
+        super().__init__()
+        self.items = items
+        self.to_json = to_json
+
+    def __iter__(self):
+        for item in self.items:
+            yield self.to_json(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return len(self.items) > 0
+
+
+def jsonify_stream(data, chunk_size: int = 64*1024) -> Iterator[bytes]:
+    """ Encodes data incrementally, producing the same bytes as flask.jsonify.
+
+    Must be consumed within an application context.
+    """
+    indent = None
+    separators = (',', ':')
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+        indent = 2
+        separators = (', ', ': ')
+
+    encoder = current_app.json_encoder(indent=indent, separators=separators,
+                                       ensure_ascii=current_app.config['JSON_AS_ASCII'],
+                                       sort_keys=current_app.config['JSON_SORT_KEYS'])
+    buffer = []
+    buffered = 0
+    for part in encoder.iterencode(data):
+        buffer.append(part)
+        buffered += len(part)
+        if buffered >= chunk_size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            buffered = 0
+    buffer.append('\n')
+    yield ''.join(buffer).encode('utf-8')
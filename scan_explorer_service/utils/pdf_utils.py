@@ -0,0 +1,134 @@
+import zlib
+from io import BytesIO
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from PIL import Image
+
+DEFAULT_DPI = 96.0  # Same as img2pdf for images without a resolution
+TIFF_PHOTOMETRIC = 262
+TIFF_FILL_ORDER = 266
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+
+
+class PdfStreamWriter:
+    """ Incremental pdf writer with one image per page.
+
+    Every page is written as soon as its image is added and only the byte
+    offsets of the objects are kept, the page tree and the cross reference
+    table follow after the last page. JPEG images and single strip Group 4
+    TIFF images are embedded as they are, other formats are decoded with
+    Pillow and stored Flate compressed.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.offsets: Dict[int, int] = {}
+        self.page_ids: List[int] = []
+        self.buffer: List[bytes] = []
+        # 1 is the catalog and 2 the page tree, written at the end
+        self.next_id = 3
+
+    def header(self) -> bytes:
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self._object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        return self._flush()
+
+    def page(self, image: bytes) -> bytes:
+        image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+
+        image_entries, image_data, width, height = image_xobject(image)
+        content = f'q {width:.4f} 0 0 {height:.4f} 0 0 cm /Im0 Do Q'.encode()
+        page = (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:.4f} {height:.4f}] '
+                f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>').encode()
+
+        self._stream(image_id, image_entries, image_data)
+        self._stream(content_id, b'', content)
+        self._object(page_id, page)
+        self.page_ids.append(page_id)
+        return self._flush()
+
+    def trailer(self) -> bytes:
+        kids = ' '.join(f'{id} 0 R' for id in self.page_ids)
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>'.encode())
+
+        xref_offset = self.offset
+        xref = [f'xref\n0 {self.next_id}\n', '0000000000 65535 f \n']
+        xref.extend(f'{self.offsets[id]:010d} 00000 n \n' for id in range(1, self.next_id))
+        xref.append(f'trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self._write(''.join(xref).encode())
+        return self._flush()
+
+    def _object(self, id: int, *parts: bytes):
+        self.offsets[id] = self.offset
+        self._write(f'{id} 0 obj\n'.encode(), *parts, b'\nendobj\n')
+
+    def _stream(self, id: int, entries: bytes, data: bytes):
+        self._object(id, b'<< ' + entries + f' /Length {len(data)} >>\nstream\n'.encode(), data, b'\nendstream')
+
+    def _write(self, *parts: bytes):
+        for part in parts:
+            self.buffer.append(part)
+            self.offset += len(part)
+
+    def _flush(self) -> bytes:
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
+def image_xobject(image: bytes) -> Tuple[bytes, bytes, float, float]:
+    """ Image XObject dictionary entries and data of an image, with the page size in points """
+    im = Image.open(BytesIO(image))
+    # Images without a resolution unit report a resolution of 1
+    dpi_x, dpi_y = (float(dpi) if float(dpi) > 1 else DEFAULT_DPI for dpi in im.info.get('dpi', (DEFAULT_DPI, DEFAULT_DPI)))
+    width, height = im.width * 72 / dpi_x, im.height * 72 / dpi_y
+    entries = f'/Type /XObject /Subtype /Image /Width {im.width} /Height {im.height}'
+
+    if im.format == 'JPEG' and im.mode in ['L', 'RGB', 'CMYK']:
+        color_space = {'L': '/DeviceGray', 'RGB': '/DeviceRGB', 'CMYK': '/DeviceCMYK'}[im.mode]
+        entries += f' /ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode'
+        if im.mode == 'CMYK':
+            # Adobe CMYK JPEGs are stored inverted
+            entries += ' /Decode [1 0 1 0 1 0 1 0]'
+        return entries.encode(), image, width, height
+
+    g4_strip = group4_strip(im, image)
+    if g4_strip is not None:
+        # WhiteIsZero is the encoding of the CCITT standard, BlackIsZero images are inverted
+        black_is_1 = 'true' if im.tag_v2.get(TIFF_PHOTOMETRIC) == 1 else 'false'
+        entries += (f' /ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /CCITTFaxDecode'
+                    f' /DecodeParms << /K -1 /Columns {im.width} /Rows {im.height} /BlackIs1 {black_is_1} >>')
+        return entries.encode(), g4_strip, width, height
+
+    if im.mode == '1':
+        bits, color_space = 1, '/DeviceGray'
+    elif im.mode == 'L':
+        bits, color_space = 8, '/DeviceGray'
+    else:
+        im = im.convert('RGB')
+        bits, color_space = 8, '/DeviceRGB'
+    entries += f' /ColorSpace {color_space} /BitsPerComponent {bits} /Filter /FlateDecode'
+    return entries.encode(), zlib.compress(im.tobytes()), width, height
+
+
+def group4_strip(im: Image.Image, image: bytes) -> Optional[bytes]:
+    """ Raw CCITT Group 4 data of a TIFF image stored in a single strip, None for any other image """
+    if im.format != 'TIFF' or im.info.get('compression') != 'group4':
+        return None
+    offsets, byte_counts = im.tag_v2.get(TIFF_STRIP_OFFSETS), im.tag_v2.get(TIFF_STRIP_BYTE_COUNTS)
+    # Strips are encoded independently and reversed bit order has no equivalent in the pdf filter
+    if not offsets or len(offsets) != 1 or len(byte_counts) != 1 or im.tag_v2.get(TIFF_FILL_ORDER, 1) != 1:
+        return None
+    if im.tag_v2.get(TIFF_PHOTOMETRIC) not in [0, 1]:
+        return None
+    return image[offsets[0]:offsets[0] + byte_counts[0]]
+
+
+def stream_pdf(images: Iterable[bytes]) -> Iterator[bytes]:
+    """ Yields a pdf with one page per image, each page as soon as its image is available """
+    writer = PdfStreamWriter()
+    yield writer.header()
+    for image in images:
+        yield writer.page(image)
+    yield writer.trailer()
@@ -1,3 +1,5 @@
+import base64
+import json
 import math
 from scan_explorer_service.models import PageType, PageColor
 import shlex
@@ -101,6 +103,19 @@ def parse_sorting_option(sort_input: str):
                 sort = sort_opt
     return sort
 
+def encode_after_token(after_key: dict) -> str:
+    """Opaque cursor of the next page of an aggregated search"""
+    return base64.urlsafe_b64encode(json.dumps(after_key, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_after_token(token: str) -> dict:
+    try:
+        after_key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        after_key = None
+    if not isinstance(after_key, dict):
+        raise Exception("%s is not a valid after token" % token)
+    return after_key
+
 def check_query(qs_dict: dict):
     """
         Checks that all queries have correct keys
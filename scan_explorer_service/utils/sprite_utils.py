@@ -0,0 +1,27 @@
+import math
+from io import BytesIO
+from typing import Iterable, List, Tuple
+from PIL import Image
+
+
+def create_sprite(images: Iterable[bytes], count: int, tile_size: int, columns: int,
+                  quality: int = 80) -> Tuple[bytes, List[Tuple[int, int, int, int]]]:
+    """ Jpeg with the images in a grid of square cells, row by row.
+
+    Every image is scaled to fit its cell and centered in it. Returns the jpeg
+    and the x, y, width and height of each image within it.
+    """
+    columns = max(1, min(columns, count))
+    sheet = Image.new('RGB', (columns * tile_size, math.ceil(count / columns) * tile_size), 'white')
+    boxes = []
+    for n, data in enumerate(images):
+        im = Image.open(BytesIO(data))
+        im.thumbnail((tile_size, tile_size))
+        x = (n % columns) * tile_size + (tile_size - im.width) // 2
+        y = (n // columns) * tile_size + (tile_size - im.height) // 2
+        sheet.paste(im.convert('RGB'), (x, y))
+        boxes.append((x, y, im.width, im.height))
+
+    output = BytesIO()
+    sheet.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue(), boxes
@@ -1,14 +1,22 @@
-from typing import Union
-from flask import Blueprint, Response, current_app, request, stream_with_context, jsonify
+from collections import deque
+from functools import partial
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+from flask import Blueprint, Response, current_app, make_response, redirect, request, send_file, stream_with_context, jsonify
 from flask_discoverer import advertise
 from urllib import parse as urlparse
-import img2pdf
-from io import BytesIO
+import json
 import math
+import os
 import sys
 import requests
+from sqlalchemy.orm import joinedload
+from scan_explorer_service.extensions import image_api_client, image_cache, image_info_cache, manifest_factory, pdf_jobs, sprite_cache, thumbnail_cache
+from scan_explorer_service.image_info import image_info
 from scan_explorer_service.models import Collection, Page, Article
-from scan_explorer_service.utils.db_utils import item_thumbnail
+from scan_explorer_service.utils.db_utils import item_thumbnail, page_by_image_path
+from scan_explorer_service.utils.pdf_utils import stream_pdf
+from scan_explorer_service.utils.sprite_utils import create_sprite
 from scan_explorer_service.utils.utils import url_for_proxy
 
 
@@ -19,24 +27,289 @@ bp_proxy = Blueprint('proxy', __name__, url_prefix='/image')
 @bp_proxy.route('/iiif/2/<path:path>', methods=['GET'])
 def image_proxy(path):
     """Proxy in between the image server and the user"""
-    req_url = urlparse.urljoin(f'{current_app.config.get("IMAGE_API_BASE_URL")}/', path)
+    if path.endswith('/info.json') and request.method == 'GET' and current_app.config.get('IMAGE_INFO_LOCAL', False):
+        response = local_image_info(path[:-len('/info.json')])
+        if response:
+            return response
+
     req_headers = {key: value for (key, value) in request.headers if key != 'Host' and key != 'Accept'}
+    req_headers.update(forwarded_headers())
+
+    key = image_cache.key(path, request.args) if request.method == 'GET' else None
+    cache_key = key if image_cache.enabled else None
+    cached = image_cache.get(cache_key) if cache_key else None
+    if cached and image_cache.is_fresh(cached[0]):
+        return cached_image_response(*cached, 'HIT')
+
+    if key and not image_cache.acquire(key):
+        # An identical request is already fetching the image, wait for it to share the body or fill the cache
+        shared = image_cache.wait(key)
+        coalesced = image_cache.get(cache_key) if cache_key and not shared else None
+        if shared or (coalesced and image_cache.is_fresh(coalesced[0])):
+            if cached:
+                cached[1].close()
+            return cached_image_response(*(shared or coalesced), 'COALESCED')
+        if coalesced:
+            coalesced[1].close()
+        return upstream_image_response(path, req_headers, cache_key, cached)
+
+    release = release_once(key) if key else None
+    try:
+        response = make_response(upstream_image_response(path, req_headers, cache_key, cached, release))
+    except BaseException:
+        if release:
+            release()
+        raise
+    return release_after_response(response, release) if release else response
+
+
+def release_once(key: str) -> Callable:
+    """ Releases an entry claimed by the request on the first call, with an optional shared response """
+    released = []
+
+    def release(shared: Optional[Tuple[dict, bytes]] = None):
+        if not released:
+            released.append(True)
+            image_cache.release(key, shared)
+
+    return release
+
+
+def release_after_response(response: Response, release: Callable) -> Response:
+    """ Releases a claimed entry once the body has been sent, and so stored, or the response is closed """
+    if not response.is_streamed:
+        release()
+        return response
+
+    def chunks(body):
+        try:
+            yield from body
+        finally:
+            release()
 
-    req_headers['X-Forwarded-Host'] = current_app.config.get('PROXY_SERVER')
-    req_headers['X-Forwarded-Path'] = current_app.config.get('PROXY_PREFIX').rstrip('/') + '/image'
+    response.response = chunks(response.response)
+    response.call_on_close(release)
+    return response
 
-    r = requests.request(request.method, req_url, params=request.args, stream=True,
-                         headers=req_headers, allow_redirects=False, data=request.form)
+
+def upstream_image_response(path: str, req_headers: dict, cache_key: str = None, cached=None, release: Callable = None):
+    """ Streams a response of the image server, revalidating or storing the cached image.
+
+    release is given when the request claimed the entry, the body is shared with the waiting requests.
+    """
+    if cached:
+        meta, body = cached
+        if meta['etag']:
+            # Let the image server confirm the cached image is still valid
+            req_headers['If-None-Match'] = meta['etag']
+            req_headers.pop('If-Modified-Since', None)
+
+    try:
+        r = image_api_client.request(request.method, path, params=request.args, stream=True,
+                                     headers=req_headers, allow_redirects=False, data=request.form)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        if cached:
+            return cached_image_response(meta, body, 'STALE')
+        if isinstance(e, requests.exceptions.Timeout):
+            return jsonify(Message='Image server timed out'), 504
+        return jsonify(Message='Image server unavailable'), 502
+
+    if cached:
+        if r.status_code == 304:
+            r.close()
+            image_cache.refresh(cache_key, meta, r.headers)
+            return cached_image_response(meta, body, 'REVALIDATED')
+        body.close()
 
     excluded_headers = ['content-encoding','content-length', 'transfer-encoding', 'connection']
     headers = [(name, value) for (name, value) in r.headers.items() if name.lower() not in excluded_headers]
 
     @stream_with_context
     def generate():
-        for chunk in r.raw.stream(decode_content=False):
-            yield chunk
+        try:
+            for chunk in r.raw.stream(decode_content=False):
+                yield chunk
+        finally:
+            # Returns the connection to the pool
+            r.close()
+
+    ttl = image_cache.ttl(r.headers)
+    etag = r.headers.get('ETag')
+    chunks = generate()
+    if release:
+        if not image_cache.shareable(r.status_code, ttl):
+            # The waiting requests have to fetch their own response
+            release()
+        elif not cache_key:
+            chunks = share_body(chunks, release, image_cache.response_meta(r.status_code, headers, etag, ttl))
+
+    if not cache_key:
+        return Response(chunks, status=r.status_code, headers=headers)
+
+    image_cache.record('MISS')
+    if r.status_code == 200 and ttl is not None and (ttl > 0 or etag):
+        chunks = image_cache.store(cache_key, r.status_code, headers, etag, ttl, chunks)
+
+    response = Response(chunks, status=r.status_code, headers=headers)
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+def share_body(chunks: Iterable[bytes], release: Callable, meta: dict) -> Iterator[bytes]:
+    """ Passes the body chunks through and shares the complete body with the waiting requests, unless it is too large """
+    body = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size <= image_cache.share_limit:
+            body.append(chunk)
+        else:
+            body.clear()
+        yield chunk
+    if size <= image_cache.share_limit:
+        release((meta, b''.join(body)))
+
+
+def local_image_info(image_path: str) -> Optional[Response]:
+    """ info.json of a page image from its dimensions in the database, None if they are unknown """
+    info = image_info_cache.get(image_path)
+    if info is None:
+        if manifest_factory.default_image_api_version != '2.0':
+            return None
+        with current_app.session_scope() as session:
+            page = page_by_image_path(session, image_path)
+            if not page or not page.width or not page.height:
+                return None
+            info = json.dumps(image_info(url_for_proxy('proxy.image_proxy', path=image_path), page.width, page.height,
+                                         manifest_factory.default_image_api_context,
+                                         manifest_factory.default_image_api_profile,
+                                         image_info_cache.tile_size)).encode('utf-8')
+        image_info_cache.set(image_path, info)
+
+    response = Response(info, mimetype='application/json')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 3600)
+    response.headers['X-Cache'] = 'LOCAL'
+    return response
+
+
+def forwarded_headers():
+    return {'X-Forwarded-Host': current_app.config.get('PROXY_SERVER'),
+            'X-Forwarded-Path': current_app.config.get('PROXY_PREFIX').rstrip('/') + '/image'}
+
+
+def fetch_image(headers: dict, path: str) -> bytes:
+    """ Loads a complete image from the image server through the image cache.
+
+    Does not depend on the request context, so it can be called from other threads.
+    """
+    key = image_cache.key(path, {})
+    cache_key = key if image_cache.enabled else None
+    image = cached_image(cache_key, 'HIT') if cache_key else None
+    if image is not None:
+        return image
+
+    leader = image_cache.acquire(key)
+    if not leader:
+        shared = image_cache.wait(key)
+        if shared:
+            image_cache.record('COALESCED')
+            return shared[1]
+        image = cached_image(cache_key, 'COALESCED') if cache_key else None
+        if image is not None:
+            return image
+
+    shared = None
+    try:
+        r = image_api_client.request('GET', path, headers=headers)
+        r.raise_for_status()
+        ttl = image_cache.ttl(r.headers)
+        etag = r.headers.get('ETag')
+        response_headers = [(name, value) for (name, value) in r.headers.items()
+                            if name.lower() not in ['content-encoding','content-length', 'transfer-encoding', 'connection']]
+        if cache_key:
+            image_cache.record('MISS')
+            if ttl is not None and (ttl > 0 or etag):
+                for _ in image_cache.store(cache_key, r.status_code, response_headers, etag, ttl, [r.content]):
+                    pass
+        if image_cache.shareable(r.status_code, ttl) and len(r.content) <= image_cache.share_limit:
+            shared = (image_cache.response_meta(r.status_code, response_headers, etag, ttl), r.content)
+        return r.content
+    finally:
+        if leader:
+            image_cache.release(key, shared)
+
+
+def cached_image(cache_key: str, cache_status: str) -> Optional[bytes]:
+    """ Body of a fresh cached image, counted as the given cache status """
+    cached = image_cache.get(cache_key)
+    if cached:
+        meta, body = cached
+        with body:
+            if image_cache.is_fresh(meta):
+                image_cache.record(cache_status)
+                return body.read()
+    return None
+
+
+def fetch_images(paths: Iterable[str], concurrency: int, memory_limit: int) -> Iterator[bytes]:
+    """ Fetches images in the worker thread pool and yields them in the order of the paths.
+
+    At most concurrency images are requested ahead of the consumer, and fewer once
+    the average image size shows the images held at the same time would exceed the
+    memory limit. Pending requests are cancelled if the consumer stops early.
+    """
+    fetch = partial(fetch_image, forwarded_headers())
+    paths = iter(paths)
+    pending = deque()
+    memory_sum = 0
+    n_images = 0
+    try:
+        while True:
+            window = concurrency
+            if n_images:
+                window = max(1, min(concurrency, int(memory_limit * n_images / memory_sum)))
+            for path in islice(paths, max(0, window - len(pending))):
+                pending.append(image_api_client.executor.submit(fetch, path))
+            if not pending:
+                break
+
+            im_data = pending.popleft().result()
+            memory_sum += sys.getsizeof(im_data)
+            n_images += 1
+            yield im_data
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def cached_image_response(meta: dict, body, cache_status: str):
+    """ Response from a cached or shared image, or 304 if it matches the conditional request of the client """
+    image_cache.record(cache_status)
+    if meta['etag'] and request.if_none_match.contains_raw(meta['etag']):
+        if not isinstance(body, bytes):
+            body.close()
+        response = Response(status=304, headers=meta['headers'])
+    elif isinstance(body, bytes):
+        response = Response(body, status=meta['status'], headers=meta['headers'])
+    else:
+        def read_chunks():
+            with body:
+                for chunk in iter(lambda: body.read(64*1024), b''):
+                    yield chunk
+
+        response = Response(read_chunks(), status=meta['status'], headers=meta['headers'])
+        response.content_length = os.fstat(body.fileno()).st_size
+
+    response.headers['X-Cache'] = cache_status
+    return response
+
 
-    return Response(generate(), status=r.status_code, headers=headers)
+@advertise(scopes=['api'], rate_limit=[300, 3600*24])
+@bp_proxy.route('/cache/stats', methods=['GET'])
+def image_cache_stats():
+    """ Statistics of the image cache of the worker handling the request """
+    return jsonify(enabled=image_cache.enabled, **image_cache.stats(), thumbnails=thumbnail_cache.stats())
 
 
 @advertise(scopes=['api'], rate_limit=[5000, 3600*24])
@@ -46,67 +319,210 @@ def image_proxy_thumbnail():
     try:
         id = request.args.get('id')
         type = request.args.get('type')
-        with current_app.session_scope() as session:
-            thumbnail_path = item_thumbnail(session, id, type)
+        path = thumbnail_cache.get(type, id)
+        if path is None:
+            with current_app.session_scope() as session:
+                thumbnail_path = item_thumbnail(session, id, type)
             path = urlparse.urlparse(thumbnail_path).path
             remove = urlparse.urlparse(url_for_proxy('proxy.image_proxy', path='')).path
             path = path.replace(remove, '')
-            return image_proxy(path)
+            thumbnail_cache.set(type, id, path)
     except Exception as e:
         return jsonify(Message=str(e)), 400
 
+    if current_app.config.get('THUMBNAIL_REDIRECT', False):
+        base_url = current_app.config.get('THUMBNAIL_REDIRECT_BASE_URL') or url_for_proxy('proxy.image_proxy', path='')
+        response = redirect(f'{base_url.rstrip("/")}/{path}', code=302)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('THUMBNAIL_REDIRECT_MAX_AGE', 3600)
+        return response
+    return image_proxy(path)
+
+def pdf_image_paths(session, id: str, page_start: int, page_end: int, dpi: int, page_limit: int) -> List[str]:
+    """ Image server paths of the pages of an article or collection within a page range """
+    scaling = float(dpi)/ 600
+    item: Union[Article, Collection] = (
+                session.query(Article).filter(Article.id == id).one_or_none()
+                or session.query(Collection).filter(Collection.id == id).one_or_none())
+
+    if isinstance(item, Article):
+        q = session.query(Article).filter(Article.id == item.id).one_or_none()
+        start_page = q.pages.first().volume_running_page_num
+        query = session.query(Page).filter(Page.articles.any(Article.id == item.id), 
+            Page.volume_running_page_num  >= page_start + start_page - 1, 
+            Page.volume_running_page_num  <= page_end + start_page - 1).order_by(Page.volume_running_page_num)
+    elif isinstance(item, Collection):
+        query = session.query(Page).filter(Page.collection_id == item.id, 
+            Page.volume_running_page_num >= page_start, 
+            Page.volume_running_page_num <= page_end).order_by(Page.volume_running_page_num)
+    else:
+        raise Exception("ID: " + id + " not found")
+
+    paths = []
+    for page in query.options(joinedload(Page.collection)).limit(page_limit):
+        size = 'full'
+        if dpi != 600:
+            size = str(int(page.width*scaling))+ ","
+        paths.append(page.image_path + "/full/" + size + f"/0/{page.image_color_quality}.tif")
+    return paths
+
+
+def write_pdf(file, id: str, page_start: int, page_end: int, dpi: int):
+    """ Writes the pdf of a background job, called in an application context """
+    with current_app.session_scope() as session:
+        paths = pdf_image_paths(session, id, page_start, page_end, dpi, current_app.config.get("PDF_JOB_PAGE_LIMIT", 1000))
+    if not paths:
+        raise Exception("No pages found")
+
+    concurrency = current_app.config.get("IMAGE_PDF_CONCURRENCY", 4)
+    for chunk in stream_pdf(fetch_images(paths, concurrency, current_app.config.get("IMAGE_PDF_MEMORY_LIMIT"))):
+        file.write(chunk)
+
+
+def pdf_job_response(status: dict):
+    job = dict(status)
+    job['status_url'] = url_for_proxy('proxy.pdf_job_status', job_id=status['id'])
+    if status['status'] == 'done':
+        job['download_url'] = url_for_proxy('proxy.pdf_job_download', job_id=status['id'])
+    return jsonify(job), 200 if status['status'] in ['done', 'failed'] else 202
+
+
 @advertise(scopes=['api'], rate_limit=[5000, 3600*24])
 @bp_proxy.route('/pdf', methods=['GET'])
 def pdf_save():
-    """Generate a PDF from pages"""
+    """Generate a PDF from pages
+
+    With job=true the PDF is created by a background job, the response is the job status.
+    """
     try:
         id = request.args.get('id')
         page_start = request.args.get('page_start', 1, int)
         page_end = request.args.get('page_end', math.inf, int)
         dpi = request.args.get('dpi', 600, int)
         dpi = min(dpi,600)
-        scaling = float(dpi)/ 600
+
+        if request.args.get('job', 'false').lower() == 'true':
+            job_id = pdf_jobs.job_id(id, page_start, page_end, dpi)
+            status = pdf_jobs.submit(job_id, partial(write_pdf, id=id, page_start=page_start, page_end=page_end, dpi=dpi))
+            return pdf_job_response(status)
+
         memory_limit = current_app.config.get("IMAGE_PDF_MEMORY_LIMIT")
         page_limit = current_app.config.get("IMAGE_PDF_PAGE_LIMIT")
+        concurrency = current_app.config.get("IMAGE_PDF_CONCURRENCY", 4)
 
-        @stream_with_context
-        def loop_images(id, page_start, page_end):
-            n_pages = 0
-            memory_sum = 0
-            with current_app.session_scope() as session:
-                item: Union[Article, Collection] = (
-                            session.query(Article).filter(Article.id == id).one_or_none()
-                            or session.query(Collection).filter(Collection.id == id).one_or_none())
-
-                if isinstance(item, Article):
-                    q = session.query(Article).filter(Article.id == item.id).one_or_none()
-                    start_page = q.pages.first().volume_running_page_num
-                    query = session.query(Page).filter(Page.articles.any(Article.id == item.id), 
-                        Page.volume_running_page_num  >= page_start + start_page - 1, 
-                        Page.volume_running_page_num  <= page_end + start_page - 1).order_by(Page.volume_running_page_num)
-                elif isinstance(item, Collection):
-                    query = session.query(Page).filter(Page.collection_id == item.id, 
-                        Page.volume_running_page_num >= page_start, 
-                        Page.volume_running_page_num <= page_end).order_by(Page.volume_running_page_num)
-                else:
-                    raise Exception("ID: " + id + " not found")
-                for page in query.all():
-                    n_pages += 1
-                    if n_pages > page_limit:
-                        break
-                    if memory_sum > memory_limit:
-                        break
-                    size = 'full'
-                    if dpi != 600:
-                        size = str(int(page.width*scaling))+ ","
-                    image_url = page.image_url + "/full/" + size + f"/0/{page.image_color_quality}.tif"
-                    path = urlparse.urlparse(image_url).path
-                    remove = urlparse.urlparse(url_for_proxy('proxy.image_proxy', path='')).path
-                    path = path.replace(remove, '')
-                    im_data = image_proxy(path).get_data()
-                    memory_sum += sys.getsizeof(im_data)
-                    yield im_data
-
-        return Response(img2pdf.convert([im for im in loop_images(id, page_start, page_end)]), mimetype='application/pdf')
+        with current_app.session_scope() as session:
+            paths = pdf_image_paths(session, id, page_start, page_end, dpi, page_limit)
+        if not paths:
+            raise Exception("No pages found")
+
+        # The first page is fetched before responding, so failures still result in an error response
+        pdf = stream_pdf(fetch_images(paths, concurrency, memory_limit))
+        first_chunks = [next(pdf), next(pdf)]
+        return Response(stream_with_context(chain(first_chunks, pdf)), mimetype='application/pdf')
+    except Exception as e:
+        return jsonify(Message=str(e)), 400
+
+
+@advertise(scopes=['api'], rate_limit=[5000, 3600*24])
+@bp_proxy.route('/pdf/jobs/<string:job_id>', methods=['GET'])
+def pdf_job_status(job_id: str):
+    """Status of a background PDF job"""
+    status = pdf_jobs.status(job_id)
+    if not status:
+        return jsonify(Message='PDF job not found'), 404
+    return pdf_job_response(status)
+
+
+@advertise(scopes=['api'], rate_limit=[5000, 3600*24])
+@bp_proxy.route('/pdf/jobs/<string:job_id>/download', methods=['GET'])
+def pdf_job_download(job_id: str):
+    """Download the PDF of a finished background job"""
+    status = pdf_jobs.status(job_id)
+    if not status:
+        return jsonify(Message='PDF job not found'), 404
+    if status['status'] != 'done':
+        return jsonify(Message=f'PDF job is {status["status"]}'), 409
+    return send_file(pdf_jobs.result_path(job_id), mimetype='application/pdf', as_attachment=True,
+                     download_name=f'{status["id"]}.pdf')
+
+
+def sprite_map(id: str, page_start: int, page_end: int) -> Tuple[str, dict]:
+    """ Cache key and offset map of the sprite of a page range of a collection, generating it if needed """
+    tile_size = current_app.config.get('SPRITE_TILE_SIZE', 128)
+    columns = current_app.config.get('SPRITE_COLUMNS', 20)
+    key = f'{id}|{page_start}|{page_end}|{tile_size}|{columns}'
+
+    with current_app.session_scope() as session:
+        collection = session.query(Collection).filter(Collection.id == id).one_or_none()
+        if not collection:
+            raise Exception("ID: " + id + " not found")
+        version = collection.updated.isoformat()
+        cached = sprite_cache.get(key, version)
+        if cached:
+            return key, cached
+
+        pages = session.query(Page).options(joinedload(Page.collection)).filter(
+            Page.collection_id == id, Page.volume_running_page_num >= page_start,
+            Page.volume_running_page_num <= page_end).order_by(Page.volume_running_page_num).all()
+        if not pages:
+            raise Exception("No pages found")
+        paths = [f'{page.image_path}/full/!{tile_size},{tile_size}/0/{page.image_color_quality}.jpg' for page in pages]
+        page_values = [{'id': page.id, 'label': page.label, 'volume_page_num': page.volume_running_page_num}
+                       for page in pages]
+
+    images = fetch_images(paths, current_app.config.get('SPRITE_CONCURRENCY', 8),
+                          current_app.config.get('IMAGE_PDF_MEMORY_LIMIT'))
+    image, boxes = create_sprite(images, len(paths), tile_size, columns)
+    for values, (x, y, width, height) in zip(page_values, boxes):
+        values.update(x=x, y=y, width=width, height=height)
+
+    new_map = {'id': id, 'tile_size': tile_size, 'columns': columns, 'pages': page_values}
+    sprite_cache.set(key, version, image, new_map)
+    return key, new_map
+
+
+def sprite_range() -> Tuple[int, int]:
+    """ The block of SPRITE_PAGE_LIMIT pages containing the requested start page.
+
+    Sprites always cover whole blocks, so shifted ranges share the same cached sprite.
+    """
+    page_limit = current_app.config.get('SPRITE_PAGE_LIMIT', 500)
+    page_start = max(request.args.get('page_start', 1, int), 1)
+    block_start = (page_start - 1) // page_limit * page_limit + 1
+    return block_start, block_start + page_limit - 1
+
+
+@advertise(scopes=['api'], rate_limit=[5000, 3600*24])
+@bp_proxy.route('/sprite/<string:id>.json', methods=['GET'])
+def sprite_json(id: str):
+    """Offsets of the pages in the sprite of the block of pages of a collection containing page_start"""
+    try:
+        page_start, page_end = sprite_range()
+        _, values = sprite_map(id, page_start, page_end)
+    except Exception as e:
+        return jsonify(Message=str(e)), 400
+
+    values = {name: value for name, value in values.items() if name != 'version'}
+    values['page_start'], values['page_end'] = page_start, page_end
+    values['sprite_url'] = url_for_proxy('proxy.sprite_image', id=id, page_start=page_start)
+    response = jsonify(values)
+    response.cache_control.max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 3600)
+    return response
+
+
+@advertise(scopes=['api'], rate_limit=[5000, 3600*24])
+@bp_proxy.route('/sprite/<string:id>.jpg', methods=['GET'])
+def sprite_image(id: str):
+    """Sprite image with the thumbnails of the block of pages of a collection containing page_start"""
+    max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 3600)
+    try:
+        page_range = sprite_range()
+        key, _ = sprite_map(id, *page_range)
+        try:
+            return send_file(sprite_cache.image_path(key), mimetype='image/jpeg', max_age=max_age)
+        except FileNotFoundError:
+            # Evicted since the lookup, the next lookup generates it again
+            key, _ = sprite_map(id, *page_range)
+            return send_file(sprite_cache.image_path(key), mimetype='image/jpeg', max_age=max_age)
     except Exception as e:
         return jsonify(Message=str(e)), 400
@@ -1,12 +1,16 @@
-
-from flask import Blueprint, current_app, jsonify, request
+import time
+from flask import Blueprint, current_app, jsonify, request, stream_with_context
 from flask_restful import abort
-from scan_explorer_service.extensions import manifest_factory
+from scan_explorer_service.extensions import manifest_factory, manifest_cache, search_cache
+from scan_explorer_service.manifest_builder import ManifestBuilder
 from scan_explorer_service.models import Article, Page, Collection
 from flask_discoverer import advertise
 from scan_explorer_service.open_search import EsFields, text_search_highlight
+from scan_explorer_service.utils.db_utils import canvas_pages, collection_articles, item_manifest_pages, item_manifest_rows, item_page_count
+from scan_explorer_service.utils.json_utils import jsonify_stream
 from scan_explorer_service.utils.utils import proxy_url, url_for_proxy
-from typing import Union
+from scan_explorer_service.views.view_utils import is_not_modified, make_etag, not_modified_response, set_cache_headers
+from typing import Callable, Optional, Union
 
 
 bp_manifest = Blueprint('manifest', __name__, url_prefix='/manifest')
@@ -14,6 +18,11 @@ bp_manifest = Blueprint('manifest', __name__, url_prefix='/manifest')
 
 @bp_manifest.before_request
 def before_request():
+    set_manifest_base_uris()
+
+
+def set_manifest_base_uris():
+    """ Points the manifest factory at the public urls of the manifest and image proxy endpoints """
     server, prefix = proxy_url()
     base_uri = f'{server}/{prefix}/manifest'
     manifest_factory.set_base_prezi_uri(base_uri)
@@ -22,25 +31,137 @@ def before_request():
     manifest_factory.set_base_image_uri(image_proxy)
 
 
+def manifest_version(item: Union[Article, Collection]) -> str:
+    """ Version of the manifest of an item, changes whenever the item is updated or the base uri moves """
+    return f'{item.updated.isoformat()}|{manifest_factory.prezi_base}'
+
+
+def search_generation() -> str:
+    """ Changes whenever the search index may have changed, on a flush of the search cache after a reindex and
+    at least every search cache ttl """
+    return f'{search_cache.flushed()}|{int(time.time() // max(search_cache.ttl, 1))}'
+
+
+def manifest_chunk_path(item_id: str, chunk: int) -> str:
+    return f'{item_id}/chunk/{chunk}'
+
+
+def manifest_chunk_label(item_id: str, first: int, last: int) -> str:
+    return f'{item_id} pages {first}-{last}'
+
+
+def create_manifest_json(session, item: Union[Article, Collection], lazy: bool = False, chunk: Optional[int] = None) -> dict:
+    """ Creates the manifest json of an item, or of one page chunk of it, using the builder selected by MANIFEST_BUILDER """
+    search_url = url_for_proxy('manifest.search', id=item.id)
+    offset, limit, path = 0, None, None
+    if chunk is not None:
+        limit = current_app.config.get('MANIFEST_CHUNK_SIZE', 500)
+        offset, path = chunk * limit, manifest_chunk_path(item.id, chunk)
+
+    if current_app.config.get('MANIFEST_BUILDER', 'prezi') == 'fast':
+        pages, links = item_manifest_rows(session, item, offset, limit)
+        label = manifest_chunk_label(item.id, offset + 1, offset + len(pages)) if path else None
+        article_id = item.id if isinstance(item, Article) else None
+        return ManifestBuilder(manifest_factory).manifest(item.id, pages, links, search_url, lazy, article_id, path, label)
+
+    pages = item_manifest_pages(session, item, offset, limit)
+    label = manifest_chunk_label(item.id, offset + 1, offset + len(pages)) if path else None
+    manifest = manifest_factory.create_manifest(item, pages, path, label)
+    manifest_factory.add_search_service(manifest, search_url)
+    return manifest_factory.manifest_to_lazy_json(manifest) if lazy else manifest.toJSON(top=True)
+
+
+def create_collection_json(session, item: Union[Article, Collection], by: str) -> dict:
+    """ Creates an IIIF collection of the article manifests or page chunk manifests of an item """
+    if by == 'article':
+        manifests = [(item.id, item.bibcode)] if isinstance(item, Article) else collection_articles(session, item.id)
+    else:
+        chunk_size = current_app.config.get('MANIFEST_CHUNK_SIZE', 500)
+        page_count = item_page_count(session, item)
+        manifests = [(manifest_chunk_path(item.id, chunk),
+                      manifest_chunk_label(item.id, first + 1, min(first + chunk_size, page_count)))
+                     for chunk, first in enumerate(range(0, page_count, chunk_size))]
+
+    return manifest_factory.create_collection(item, manifests).toJSON(top=True)
+
+
+def cached_json_response(cache_key: str, version: str, last_modified, create_json: Callable[[bool], dict]):
+    """ Serves json from the manifest cache, creating and caching it on a miss """
+    etag = make_etag(cache_key, version)
+    if is_not_modified(etag, last_modified):
+        return not_modified_response(etag, last_modified)
+
+    body = manifest_cache.get(cache_key, version)
+    if body is None:
+        if current_app.config.get('MANIFEST_STREAMING', False):
+            chunks = jsonify_stream(create_json(True))
+            body = stream_with_context(manifest_cache.set_from_stream(cache_key, version, chunks))
+        else:
+            body = jsonify(create_json(False)).get_data()
+            manifest_cache.set(cache_key, version, body)
+
+    response = current_app.response_class(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+    return set_cache_headers(response, etag, last_modified)
+
+
+def get_item(session, id: str) -> Optional[Union[Article, Collection]]:
+    return (session.query(Article).filter(Article.id == id).one_or_none()
+            or session.query(Collection).filter(Collection.id == id).one_or_none())
+
+
 @advertise(scopes=['api'], rate_limit=[300, 3600*24])
 @bp_manifest.route('/<string:id>/manifest.json', methods=['GET'])
 def get_manifest(id: str):
     """ Creates an IIIF manifest from an article or Collection"""
     with current_app.session_scope() as session:
-        item: Union[Article, Collection] = (
-            session.query(Article).filter(Article.id == id).one_or_none()
-            or session.query(Collection).filter(Collection.id == id).one_or_none())
+        item = get_item(session, id)
 
         if item:
-            manifest = manifest_factory.create_manifest(item)
-            search_url = url_for_proxy('manifest.search', id=id)
-            manifest_factory.add_search_service(manifest, search_url)
+            return cached_json_response(item.id, manifest_version(item), item.updated,
+                                        lambda lazy: create_manifest_json(session, item, lazy))
+        else:
+            return jsonify(exception='Article not found'), 404
+
+
+@advertise(scopes=['api'], rate_limit=[300, 3600*24])
+@bp_manifest.route('/<string:id>/collection.json', methods=['GET'])
+def get_manifest_collection(id: str):
+    """ Creates an IIIF collection of smaller manifests from an article or Collection
 
-            return manifest.toJSON(top=True)
+    The manifests are the page chunks of the item, or with by=article the article manifests.
+    """
+    by = request.args.get('by', current_app.config.get('MANIFEST_COLLECTION_MODE', 'pages'))
+    if by not in ['pages', 'article']:
+        return jsonify(exception='Invalid collection mode, must be pages or article'), 400
+
+    with current_app.session_scope() as session:
+        item = get_item(session, id)
+
+        if item:
+            version = f'{manifest_version(item)}|{current_app.config.get("MANIFEST_CHUNK_SIZE", 500)}'
+            return cached_json_response(f'{item.id}/collection/{by}', version, item.updated,
+                                        lambda lazy: create_collection_json(session, item, by))
         else:
             return jsonify(exception='Article not found'), 404
 
 
+@advertise(scopes=['api'], rate_limit=[300, 3600*24])
+@bp_manifest.route('/<string:id>/chunk/<int:chunk>/manifest.json', methods=['GET'])
+def get_manifest_chunk(id: str, chunk: int):
+    """ Creates an IIIF manifest from one page chunk of an article or Collection"""
+    with current_app.session_scope() as session:
+        item = get_item(session, id)
+        chunk_size = current_app.config.get('MANIFEST_CHUNK_SIZE', 500)
+
+        if item and chunk * chunk_size < item_page_count(session, item):
+            path = manifest_chunk_path(item.id, chunk)
+            version = f'{manifest_version(item)}|{chunk_size}'
+            return cached_json_response(path, version, item.updated,
+                                        lambda lazy: create_manifest_json(session, item, lazy, chunk))
+        else:
+            return jsonify(exception='Article or page chunk not found'), 404
+
+
 @advertise(scopes=['api'], rate_limit=[300, 3600*24])
 @bp_manifest.route('/canvas/<string:page_id>.json', methods=['GET'])
 def get_canvas(page_id: str):
@@ -48,12 +169,55 @@ def get_canvas(page_id: str):
     with current_app.session_scope() as session:
         page = session.query(Page).filter(Page.id == page_id).first()
         if page:
+            etag = make_etag(page.id, page.updated.isoformat(), manifest_factory.prezi_base)
+            if is_not_modified(etag, page.updated):
+                return not_modified_response(etag, page.updated)
+
             canvas = manifest_factory.get_or_create_canvas(page)
-            return canvas.toJSON(top=True)
+            return set_cache_headers(jsonify(canvas.toJSON(top=True)), etag, page.updated)
         else:
             return jsonify(exception='Page not found'), 404
 
 
+@advertise(scopes=['api'], rate_limit=[300, 3600*24])
+@bp_manifest.route('/canvases', methods=['GET'])
+def get_canvases():
+    """ Creates IIIF canvases from a comma separated list of page ids,
+    or from a page range within a collection """
+    ids = request.args.get('ids')
+    collection_id = request.args.get('id')
+    page_start = request.args.get('page_start', 1, int)
+    page_end = request.args.get('page_end', None, int)
+    limit = current_app.config.get('CANVAS_BATCH_LIMIT', 1000)
+
+    if ids:
+        page_ids = list(dict.fromkeys(ids.split(',')))
+        if len(page_ids) > limit:
+            return jsonify(exception=f'At most {limit} canvases can be requested at once'), 400
+    elif collection_id:
+        page_ids = None
+        if page_end is None or page_end - page_start >= limit:
+            page_end = page_start + limit - 1
+    else:
+        return jsonify(exception='No page ids or collection specified'), 400
+
+    with current_app.session_scope() as session:
+        pages = canvas_pages(session, page_ids, collection_id, page_start, page_end)
+        if not pages:
+            return jsonify(exception='Pages not found'), 404
+        if page_ids:
+            order = {page_id: n for n, page_id in enumerate(page_ids)}
+            pages.sort(key=lambda page: order[page.id])
+
+        last_modified = max(page.updated for page in pages)
+        etag = make_etag(manifest_factory.prezi_base, *(f'{page.id}|{page.updated.isoformat()}' for page in pages))
+        if is_not_modified(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+
+        canvases = [manifest_factory.get_or_create_canvas(page).toJSON(top=True) for page in pages]
+        return set_cache_headers(jsonify(canvases=canvases), etag, last_modified)
+
+
 @advertise(scopes=['api'], rate_limit=[300, 3600*24])
 @bp_manifest.route('/<string:id>/search', methods=['GET'])
 def search(id: str):
@@ -64,10 +228,13 @@ def search(id: str):
         return jsonify(exception='No search query specified'), 400
 
     with current_app.session_scope() as session:
-        item: Union[Article, Collection] = (
-                    session.query(Article).filter(Article.id == id).one_or_none()
-                    or session.query(Collection).filter(Collection.id == id).one_or_none())
+        item = get_item(session, id)
         if item:
+            # The results depend on the search index as well, which the item doesn't date
+            etag = make_etag(item.id, manifest_version(item), request.url, search_generation())
+            if is_not_modified(etag):
+                return not_modified_response(etag)
+
             annotation_list = manifest_factory.annotationList(request.url)
             annotation_list.resources = []
             
@@ -81,7 +248,7 @@ def search(id: str):
                 highlight_text = "<br><br>".join(res['highlight']).replace("em>", "b>")
                 annotation.text(highlight_text, format="text/html")
 
-            return annotation_list.toJSON(top=True)
+            return set_cache_headers(jsonify(annotation_list.toJSON(top=True)), etag)
 
 
         else:
@@ -1,11 +1,12 @@
 from typing import Union
 from flask import Blueprint, current_app, jsonify, request
-from scan_explorer_service.utils.db_utils import article_get_or_create, article_overwrite, collection_overwrite, page_get_or_create, page_overwrite
+from scan_explorer_service.utils.db_utils import article_get_or_create, article_overwrite, articles_touch, collection_overwrite, collection_touch, page_get_or_create, page_overwrite
+from scan_explorer_service.extensions import image_info_cache, manifest_cache, search_cache, thumbnail_cache
 from scan_explorer_service.models import Article, Collection, Page
 from flask_discoverer import advertise
 from scan_explorer_service.utils.search_utils import *
 from scan_explorer_service.views.view_utils import ApiErrors
-from scan_explorer_service.open_search import EsFields, page_os_search, aggregate_search, page_ocr_os_search
+from scan_explorer_service.open_search import EsFields, article_os_search, page_os_search, aggregate_search, page_ocr_os_search, next_after_token
 import requests
 
 bp_metadata = Blueprint('metadata', __name__, url_prefix='/metadata')
@@ -54,7 +55,12 @@ def put_article():
         with current_app.session_scope() as session:
             try:
                 article = Article(**json)
-                article_overwrite(session, article)
+                # The pages of the replaced article are deleted with it, the other articles of those pages changed as well
+                other_article_ids = article_overwrite(session, article)
+                collection_touch(session, article.collection_id)
+                articles_touch(session, other_article_ids)
+                manifest_cache.invalidate(article.id, article.collection_id, *other_article_ids)
+                thumbnail_cache.invalidate(article.id, article.collection_id, *other_article_ids)
                 return jsonify({'id': article.bibcode}), 200
             except:
                 session.rollback()
@@ -73,6 +79,8 @@ def put_collection():
             try:
                 collection = Collection(**json)
                 collection_overwrite(session, collection)
+                article_ids = set()
+                pages = []
                 
                 for page_json in json.get('pages', []):
                     page_json['collection_id'] = collection.id
@@ -80,10 +88,16 @@ def put_collection():
 
                     for article_json in page_json.get('articles', []):
                         article_json['collection_id'] = collection.id
-                        page.articles.append(article_get_or_create(session, **article_json))
+                        article = article_get_or_create(session, **article_json)
+                        page.articles.append(article)
+                        article_ids.add(article.id)
 
                     session.add(page)
+                    pages.append(page)
                 session.commit()
+                manifest_cache.invalidate(collection.id, *article_ids)
+                thumbnail_cache.invalidate(collection.id, *article_ids, *[page.id for page in pages])
+                image_info_cache.invalidate(*[page.image_path for page in pages])
 
                 return jsonify({'id': collection.id}), 200
             except:
@@ -102,15 +116,22 @@ def put_page():
         with current_app.session_scope() as session:
             try:
                 page = Page(**json)
-                page_overwrite(session, page)
+                previous_article_ids = page_overwrite(session, page)
 
                 for article_json in json.get('articles', []):
                     article_json['collection_id'] = page.collection_id
                     page.articles.append(article_get_or_create(session, **article_json))
 
                 session.add(page)
+                # Articles which lost the page changed as well
+                article_ids = list(dict.fromkeys([article.id for article in page.articles] + previous_article_ids))
+                collection_touch(session, page.collection_id)
+                articles_touch(session, article_ids)
                 session.commit()
                 session.refresh(page)
+                manifest_cache.invalidate(page.collection_id, *article_ids)
+                thumbnail_cache.invalidate(page.id, page.collection_id, *article_ids)
+                image_info_cache.invalidate(page.image_path)
                 return jsonify({'id': page.id}), 200
             except:
                 session.rollback()
@@ -119,23 +140,57 @@ def put_page():
         return jsonify(message='Invalid page json'), 400
 
 
+def cached_search_response(body: bytes):
+    response = current_app.response_class(body, mimetype='application/json')
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+def search_response(cache_key: str, result: dict):
+    """Serializes a search result and caches it for repeated searches"""
+    response = jsonify(result)
+    if search_cache.enabled:
+        search_cache.set(cache_key, response.get_data())
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+@advertise(scopes=['ads:scan-explorer'], rate_limit=[300, 3600*24])
+@bp_metadata.route('/search/cache', methods=['DELETE'])
+def flush_search_cache():
+    """Drops all cached search responses, for example after the search index was rebuilt"""
+    search_cache.flush()
+    return jsonify(message='Search cache flushed'), 200
+
+
 @advertise(scopes=['api'], rate_limit=[300, 3600*24])
 @bp_metadata.route('/article/search', methods=['GET'])
 def article_search():
-    """Search for an article using one or some of the available keywords"""
+    """Search for an article using one or some of the available keywords.
+
+    An empty after argument switches to cursor paging, the response then has the after token of the next page.
+    """
     try:
         qs, qs_dict, page, limit, sort = parse_query_args(request.args)
-        result = aggregate_search(qs, EsFields.article_id, page, limit, sort)
+        after = request.args.get('after')
+        cache_key = search_cache.key(request.endpoint, qs, page, limit, sort, after)
+        cached = search_cache.get(cache_key) if search_cache.enabled else None
+        if cached:
+            return cached_search_response(cached)
+
+        result, collection_count, page_count = article_os_search(qs, page, limit, sort, after)
         text_query = ''
         if SearchOptions.FullText.value in qs_dict.keys():
             text_query = qs_dict[SearchOptions.FullText.value]
 
         article_count = result['aggregations']['total_count']['value']
-        collection_count = page_count = 0
-        if article_count == 0:
-            collection_count = aggregate_search(qs, EsFields.volume_id, page, limit, sort)['aggregations']['total_count']['value']
-            page_count = page_os_search(qs, page, limit, sort)['hits']['total']['value']
-        return jsonify(serialize_os_article_result(result, page, limit, text_query, collection_count, page_count))
+        if article_count > 0:
+            # The counts are only shown as alternatives to an empty result
+            collection_count = page_count = 0
+        response = serialize_os_article_result(result, page, limit, text_query, collection_count, page_count)
+        if after is not None:
+            response['after'] = next_after_token(result, limit)
+        return search_response(cache_key, response)
     except Exception as e:
         return jsonify(message=str(e), type=ApiErrors.SearchError.value), 400
 
@@ -143,14 +198,23 @@ def article_search():
 @advertise(scopes=['api'], rate_limit=[300, 3600*24])
 @bp_metadata.route('/collection/search', methods=['GET'])
 def collection_search():
-    """Search for a collection using one or some of the available keywords"""
+    """Search for a collection using one or some of the available keywords, cursor paged like the article search"""
     try:
         qs, qs_dict, page, limit, sort = parse_query_args(request.args)
-        result = aggregate_search(qs, EsFields.volume_id, page, limit, sort)
+        after = request.args.get('after')
+        cache_key = search_cache.key(request.endpoint, qs, page, limit, sort, after)
+        cached = search_cache.get(cache_key) if search_cache.enabled else None
+        if cached:
+            return cached_search_response(cached)
+
+        result = aggregate_search(qs, EsFields.volume_id, page, limit, sort, after)
         text_query = ''
         if SearchOptions.FullText.value in qs_dict.keys():
             text_query = qs_dict[SearchOptions.FullText.value]
-        return jsonify(serialize_os_collection_result(result, page, limit, text_query))
+        response = serialize_os_collection_result(result, page, limit, text_query)
+        if after is not None:
+            response['after'] = next_after_token(result, limit)
+        return search_response(cache_key, response)
     except Exception as e:
         return jsonify(message=str(e), type=ApiErrors.SearchError.value), 400
 
@@ -160,11 +224,16 @@ def page_search():
     """Search for a page using one or some of the available keywords"""
     try:
         qs, qs_dict, page, limit, sort = parse_query_args(request.args)
+        cache_key = search_cache.key(request.endpoint, qs, page, limit, sort)
+        cached = search_cache.get(cache_key) if search_cache.enabled else None
+        if cached:
+            return cached_search_response(cached)
+
         result = page_os_search(qs, page, limit, sort)
         text_query = ''
         if SearchOptions.FullText.value in qs_dict.keys():
             text_query = qs_dict[SearchOptions.FullText.value]
-        return jsonify(serialize_os_page_result(result, page, limit, text_query))
+        return search_response(cache_key, serialize_os_page_result(result, page, limit, text_query))
     except Exception as e:
         return jsonify(message=str(e), type=ApiErrors.SearchError.value), 400
 
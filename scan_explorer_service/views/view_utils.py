@@ -1,4 +1,42 @@
 import enum
+import hashlib
+from datetime import datetime, timezone
+from typing import Optional
+from flask import Response, current_app, request
 
 class ApiErrors(enum.Enum):
-    SearchError = 1
\ No newline at end of file
+    SearchError = 1
+
+
+def make_etag(*parts) -> str:
+    """Strong entity tag built from the values which determine a representation"""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0)
+
+
+def is_not_modified(etag: str, last_modified: Optional[datetime] = None) -> bool:
+    """Checks the If-None-Match and If-Modified-Since headers of the current request"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return _as_utc(last_modified) <= _as_utc(request.if_modified_since)
+    return False
+
+
+def set_cache_headers(response: Response, etag: str, last_modified: Optional[datetime] = None) -> Response:
+    """Adds validators and caching directives to a response"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = _as_utc(last_modified)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('HTTP_CACHE_MAX_AGE', 0)
+    return response
+
+
+def not_modified_response(etag: str, last_modified: Optional[datetime] = None) -> Response:
+    return set_cache_headers(current_app.response_class(status=304), etag, last_modified)